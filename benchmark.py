@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Benchmark harness for the queries of query.py
+
+For every vehicle of a folder, the trace is loaded and each query evaluated
+on it, after warmup runs, repeat times; loading and evaluation are timed
+apart with the monotonic clock of highest resolution (time.perf_counter_ns),
+and summarized by their median, 95th percentile, minimum and mean, in
+milliseconds. With memory=True, the peak of the memory allocated by Python
+during a load and during each evaluation is measured with tracemalloc, in
+one extra run that is not timed, tracing being slow.
+
+The report is a dict written as JSON by write_json; write_legacy writes the
+time.dat and q.dat files of query.generate_time_q_files from it.
+"""
+
+import json
+import tracemalloc
+from math import ceil
+from statistics import mean, median
+from time import perf_counter_ns
+
+from query import (format_row, is_fleet, load, vehicle_file, vehicles,
+                   q1, q2, q3, q4, q5, q6, q7, q8, q9, q10)
+
+STATS = ("median", "p95", "min", "mean")
+
+def summarize(times):
+    """ Statistics (ms) of a list of durations (ns) """
+    ms = sorted(t / 1e6 for t in times)
+    return {"median": median(ms), "p95": ms[ceil(0.95 * len(ms)) - 1],
+            "min": ms[0], "mean": mean(ms), "runs": len(ms)}
+
+def timed(f, *args):
+    start = perf_counter_ns()
+    res = f(*args)
+    return res, perf_counter_ns() - start
+
+def peak_memory(f, *args):
+    """ Peak memory (bytes) allocated by Python while running f(*args) """
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark_vehicle(folder, vehicle, queries, loadf=load, repeat=5,
+                      warmup=1, memory=False):
+    """ Report of the queries on the trace of vehicle
+
+    {"vehicle", "load": stats, "queries": [{"name", "result", "evaluate":
+    stats}, ...]}, with "peak_bytes" entries when memory is True """
+    filename = vehicle_file(folder, vehicle)
+    loadtimes, evaltimes = [], [[] for _ in queries]
+    results = [None] * len(queries)
+    for run in range(warmup + repeat):
+        data, ltime = timed(loadf, filename)
+        times = []
+        for i, q in enumerate(queries):
+            results[i], qtime = timed(q, data)
+            times.append(qtime)
+        if run >= warmup:
+            loadtimes.append(ltime)
+            for qtimes, qtime in zip(evaltimes, times):
+                qtimes.append(qtime)
+
+    report = {"vehicle": vehicle, "load": summarize(loadtimes), "queries": [
+        {"name": q.__name__, "result": int(res), "evaluate": summarize(qtimes)}
+        for q, res, qtimes in zip(queries, results, evaltimes)]}
+    if memory:
+        report["load"]["peak_bytes"] = peak_memory(loadf, filename)
+        data = loadf(filename)
+        for q, entry in zip(queries, report["queries"]):
+            entry["evaluate"]["peak_bytes"] = peak_memory(q, data)
+    return report
+
+def benchmark(folder, queries, loadf=load, repeat=5, warmup=1, memory=False):
+    """ Report of the queries on every vehicle of folder (a directory or a
+    fleet object, see query.vehicles) """
+    return {"config": {"queries": [q.__name__ for q in queries],
+                       "loadf": getattr(loadf, "__name__", repr(loadf)),
+                       "repeat": repeat, "warmup": warmup,
+                       "clock": "perf_counter_ns", "unit": "ms"},
+            "vehicles": [benchmark_vehicle(folder, vehicle, queries, loadf,
+                                           repeat, warmup, memory)
+                         for vehicle in vehicles(folder)]}
+
+def write_json(report, filename):
+    with open(filename, "w") as file:
+        json.dump(report, file, indent=1)
+
+def write_legacy(report, timefilename="time.dat", qfilename="q.dat",
+                 stat="mean", with_load=True):
+    # time.dat gets stat of each query's times, rounded as in
+    # generate_time_q_files; with_load adds the load time to each of them,
+    # as the short queries of query.py load their trace themselves
+    with open(timefilename, "w") as filetime, open(qfilename, "w") as fileq:
+        for entry in report["vehicles"]:
+            load_ms = entry["load"][stat] if with_load else 0
+            filetime.write(format_row(entry["vehicle"],
+                [round(q["evaluate"][stat] + load_ms, 2) for q in entry["queries"]]))
+            fileq.write(format_row(entry["vehicle"],
+                                   [q["result"] for q in entry["queries"]]))
+
+beijing_queries = [q1, q2, q3, q4, q5, q6, q7, q8, q9, q10]
+
+def benchmark_beijing(folder, jsonfilename="benchmark.json",
+                      timefilename=None, qfilename=None, repeat=5, warmup=1,
+                      memory=False):
+    report = benchmark(folder, beijing_queries,
+                       folder.load if is_fleet(folder) else load,
+                       repeat, warmup, memory)
+    write_json(report, jsonfilename)
+    if timefilename and qfilename:
+        write_legacy(report, timefilename, qfilename)
+    return report
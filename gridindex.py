@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""Fleet-wide spatial grid index over GPS records
+
+The Beijing bounding box (b1, b2 in query.py) is cut into square cells, and
+every cell lists the (vehicle, row range) runs of records falling in it. A
+box query (p1, p2), with the conventions of query.is_within, then only visits
+the cells overlapping the box: the records of the cells strictly inside the
+box are within it without any check, and only the records of the cells on
+its border are checked one by one. Records outside the bounding box go to
+an overflow cell, which is on the border of every box.
+
+Cell coordinates are computed with the same floating-point operations for
+records and box corners, and they are monotone in the coordinates, so the
+inside/border classification never changes an answer.
+
+The index records the identity of every trace it was built from (see
+trace_identity); traces that changed since are scanned in full instead.
+"""
+
+from math import ceil
+from os import stat
+from os.path import join
+
+import numpy as np
+
+from query import (b1, b2, bulk_load, is_fleet, is_within, load_vehicle,
+                   passed_by, stayed_in, vehicles)
+from tracestore import Trace
+
+
+def trace_identity(folder, vehicle):
+    # (mtime_ns, size) of a trace file, or (-1, number of records) of the
+    # trace of a fleet object
+    if not is_fleet(folder):
+        st = stat(join(folder, vehicle))
+        return (st.st_mtime_ns, st.st_size)
+    if hasattr(folder, "offsets"):
+        i = folder.index[vehicle]
+        return (-1, folder.offsets[i+1] - folder.offsets[i])
+    return (-1, len(folder.load(vehicle)))
+
+
+class GridIndex(object):
+    """ Postings of the records of a fleet in a uniform grid
+
+    Postings are sorted by cell, then vehicle, then row: the postings of
+    cell c are cell_offsets[c]:cell_offsets[c+1] in the posting_* arrays. """
+
+    def __init__(self, vehicles, p1, p2, cellsize, cell_offsets,
+                 posting_vehicle, posting_start, posting_end,
+                 identities=None, digest=""):
+        self.vehicles = list(vehicles)
+        # identities of the traces, and digest of the store, if any; an
+        # index without identities is stale for every trace
+        self.identities = identities
+        self.digest = digest
+        self.p1, self.p2, self.cellsize = tuple(p1), tuple(p2), cellsize
+        self.nlat = int(ceil((p1[0] - p2[0]) / cellsize))
+        self.nlon = int(ceil((p2[1] - p1[1]) / cellsize))
+        self.overflow = self.nlat * self.nlon
+        self.cell_offsets = cell_offsets
+        self.posting_vehicle = posting_vehicle
+        self.posting_start = posting_start
+        self.posting_end = posting_end
+
+    ## Building
+
+    @classmethod
+    def build(cls, folder, cellsize=0.005, p1=b1, p2=b2, loadf=bulk_load):
+        """ Indexes every trace of folder (a directory or a TraceStore) """
+        index = cls(vehicles(folder), p1, p2, cellsize, None, None, None, None,
+                    None, getattr(folder, "digest", None) or "")
+        index.identities = np.array([trace_identity(folder, vehicle)
+                                     for vehicle in index.vehicles],
+                                    dtype=np.int64).reshape(-1, 2)
+        cells, vids, starts, ends = [], [], [], []
+        for v, vehicle in enumerate(index.vehicles):
+            data = load_vehicle(folder, vehicle, loadf)
+            if not isinstance(data, Trace):
+                data = Trace.from_records(data)
+            if not data:
+                continue
+            ids = index.cells(data.lat, data.lon)
+            change = np.flatnonzero(np.diff(ids)) + 1
+            start = np.concatenate(([0], change))
+            cells.append(ids[start])
+            starts.append(start)
+            ends.append(np.concatenate((change, [len(ids)])))
+            vids.append(np.full(len(start), v))
+
+        if cells:
+            cells = np.concatenate(cells)
+            order = np.argsort(cells, kind="stable")
+            cells = cells[order]
+            index.posting_vehicle = np.concatenate(vids)[order].astype(np.int32)
+            index.posting_start = np.concatenate(starts)[order].astype(np.int64)
+            index.posting_end = np.concatenate(ends)[order].astype(np.int64)
+        else:
+            cells = np.empty(0, dtype=np.int64)
+            index.posting_vehicle = np.empty(0, dtype=np.int32)
+            index.posting_start = index.posting_end = np.empty(0, dtype=np.int64)
+        index.cell_offsets = np.searchsorted(cells,
+                                             np.arange(index.overflow + 2))
+        return index
+
+    def _row(self, lat):
+        return np.floor((lat - self.p2[0]) / self.cellsize)
+
+    def _col(self, lon):
+        return np.floor((lon - self.p1[1]) / self.cellsize)
+
+    def cells(self, lat, lon):
+        """ Cell ids of arrays of coordinates """
+        r, c = self._row(lat), self._col(lon)
+        inside = (r >= 0) & (r < self.nlat) & (c >= 0) & (c < self.nlon)
+        return np.where(inside, r * self.nlon + c, self.overflow).astype(np.int64)
+
+    def stale(self, folder):
+        """ Set of the vehicles whose trace changed since it was indexed
+
+        Raises ValueError if folder does not have the vehicles of the index. """
+        if vehicles(folder) != self.vehicles:
+            raise ValueError('the grid index was built for other vehicles')
+        if (self.identities is None or
+            self.digest != (getattr(folder, "digest", None) or "")):
+            return set(self.vehicles)
+        return {vehicle for vehicle, identity in
+                zip(self.vehicles, self.identities.tolist())
+                if tuple(identity) != trace_identity(folder, vehicle)}
+
+    ## Persistence
+
+    def save(self, filename):
+        np.savez(filename, vehicles=np.array(self.vehicles),
+                 grid=np.array(self.p1 + self.p2 + (self.cellsize,)),
+                 cell_offsets=self.cell_offsets,
+                 posting_vehicle=self.posting_vehicle,
+                 posting_start=self.posting_start,
+                 posting_end=self.posting_end,
+                 identities=self.identities, digest=np.array(self.digest))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            lat1, lon1, lat2, lon2, cellsize = f["grid"].tolist()
+            identities = f["identities"] if "identities" in f else None
+            digest = str(f["digest"]) if "digest" in f else ""
+            return cls(f["vehicles"].tolist(), (lat1, lon1), (lat2, lon2),
+                       cellsize, f["cell_offsets"], f["posting_vehicle"],
+                       f["posting_start"], f["posting_end"], identities, digest)
+
+    ## Box queries
+
+    def _postings(self, cells):
+        parts = [np.arange(self.cell_offsets[a], self.cell_offsets[b])
+                 for a, b in cells]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def box(self, p1, p2):
+        """ Postings of the records that may be within the box (p1, p2)
+
+        Returns (inside, border), two arrays of posting numbers: the records
+        of the inside postings are all within the box, those of the border
+        postings have to be checked. """
+        rlo, rhi = int(self._row(p2[0])), int(self._row(p1[0]))
+        clo, chi = int(self._col(p1[1])), int(self._col(p2[1]))
+        inside, border = [], [(self.overflow, self.overflow + 1)]
+        jlo, jhi = max(clo, 0), min(chi, self.nlon - 1)
+        ilo, ihi = max(clo + 1, 0), min(chi - 1, self.nlon - 1)
+        for r in range(max(rlo, 0), min(rhi, self.nlat - 1) + 1):
+            if jlo > jhi:
+                break
+            first = r * self.nlon
+            if rlo < r < rhi and ilo <= ihi:
+                inside.append((first + ilo, first + ihi + 1))
+                border.append((first + jlo, first + ilo))
+                border.append((first + ihi + 1, first + jhi + 1))
+            else:
+                border.append((first + jlo, first + jhi + 1))
+        return self._postings(inside), self._postings(border)
+
+    def candidates(self, p1, p2):
+        """ Candidate vehicles of the box (p1, p2) and their record ranges
+
+        Returns {vehicle: [(start, end, inside), ...]} with ranges sorted by
+        start; inside tells whether all the records of the range are within
+        the box. """
+        result = {}
+        for postings, inside in zip(self.box(p1, p2), (True, False)):
+            for v, start, end in zip(self.posting_vehicle[postings].tolist(),
+                                     self.posting_start[postings].tolist(),
+                                     self.posting_end[postings].tolist()):
+                result.setdefault(self.vehicles[v], []).append((start, end, inside))
+        for ranges in result.values():
+            ranges.sort()
+        return result
+
+    def rows_within(self, folder, p1, p2, loadf=bulk_load, stale=None):
+        """ {vehicle: sorted rows of its records within the box (p1, p2)},
+        for the vehicles with at least one such record """
+        stale = self.stale(folder) if stale is None else stale
+        result = {}
+        for vehicle in stale:
+            data = load_vehicle(folder, vehicle, loadf)
+            rows = [i for i in range(len(data))
+                    if is_within(data[i][1], data[i][2], p1, p2)]
+            if rows:
+                result[vehicle] = rows
+        for vehicle, ranges in self.candidates(p1, p2).items():
+            if vehicle in stale:
+                continue
+            data = None
+            rows = []
+            for start, end, inside in ranges:
+                if inside:
+                    rows.extend(range(start, end))
+                    continue
+                if data is None:
+                    data = load_vehicle(folder, vehicle, loadf)
+                rows.extend(i for i in range(start, end)
+                            if is_within(data[i][1], data[i][2], p1, p2))
+            if rows:
+                result[vehicle] = rows
+        return result
+
+
+### Fleet-wide versions of the box templates of query.py
+# Same answers as apply_query(folder, passed_by, p1, p2), and so on, in the
+# order of the vehicles of the index; stale traces are evaluated in full.
+
+def passed_by_fleet(index, folder, p1, p2, loadf=bulk_load):
+    stale = index.stale(folder)
+    hits = {vehicle for vehicle in stale
+            if passed_by(load_vehicle(folder, vehicle, loadf), p1, p2)}
+    for vehicle, ranges in index.candidates(p1, p2).items():
+        if vehicle in stale:
+            continue
+        if any(inside for _, _, inside in ranges):
+            hits.add(vehicle)
+            continue
+        data = load_vehicle(folder, vehicle, loadf)
+        if any(is_within(data[i][1], data[i][2], p1, p2)
+               for start, end, _ in ranges for i in range(start, end)):
+            hits.add(vehicle)
+    return [vehicle in hits for vehicle in index.vehicles]
+
+def stayed_in_fleet(index, folder, p1, p2, loadf=bulk_load):
+    # a vehicle stayed in the box iff all its records are within it
+    stale = index.stale(folder)
+    within = index.rows_within(folder, p1, p2, loadf, stale)
+    sizes = np.zeros(len(index.vehicles), dtype=np.int64)
+    np.add.at(sizes, index.posting_vehicle,
+              index.posting_end - index.posting_start)
+    return [stayed_in(load_vehicle(folder, vehicle, loadf), p1, p2)
+            if vehicle in stale else
+            len(within.get(vehicle, ())) == sizes[v] > 0
+            for v, vehicle in enumerate(index.vehicles)]
+
+def space_filter_fleet(index, folder, p1, p2, loadf=bulk_load):
+    within = index.rows_within(folder, p1, p2, loadf)
+    result = []
+    for vehicle in index.vehicles:
+        rows = within.get(vehicle)
+        if not rows:
+            result.append([])
+            continue
+        data = load_vehicle(folder, vehicle, loadf)
+        result.append([(data[i][0], data[i][1], data[i][2]) for i in rows])
+    return result
@@ -13,9 +13,11 @@ import heapq
 import itertools
 import operator
 import math
-from collections import deque
+from collections import deque, namedtuple
 from functools import wraps
 
+import numpy as np
+
 __author__ = u'Stefan Kögl <stefan@skoegl.net>'
 __version__ = '0.16'
 __website__ = 'https://github.com/stefankoegl/kdtree'
@@ -492,25 +494,181 @@ class KDNode(Node):
         return next(iter(self.search_knn(point, 1, dist)), None)
 
 
-    def _search_nn_dist(self, point, dist, results, get_dist):
-        if not self:
-            return
+    def _nearest(self, point):
+        # search_knn(point, 1) without its heap, counter, closures and final
+        # sort: nodes are visited in the same order and compared with the
+        # same strict tests, so ties are resolved the same way
+        best, best_dist = None, None
+        dimensions = range(self.dimensions)
+        stack = [(self, None)]
+        while stack:
+            node, plane_dist2 = stack.pop()
+            if plane_dist2 is not None and not plane_dist2 < best_dist:
+                continue
+            data = node.data
+            if data is None:
+                continue
+
+            node_dist = 0
+            for i in dimensions:
+                d = data[i] - point[i]
+                node_dist += d * d
+            if best is None or node_dist < best_dist:
+                best, best_dist = node, node_dist
+
+            # the far side is searched after the near one, if the splitting
+            # plane is closer than the best node found by then
+            plane_dist = point[node.axis] - data[node.axis]
+            if plane_dist < 0:
+                near, far = node.left, node.right
+            else:
+                near, far = node.right, node.left
+            if far is not None:
+                stack.append((far, plane_dist * plane_dist))
+            if near is not None:
+                stack.append((near, None))
 
-        nodeDist = get_dist(self)
+        return None if best is None else (best, best_dist)
 
-        if nodeDist < dist:
-            results.append(self.data)
 
-        # get the splitting plane
-        split_plane = self.data[self.axis]
+    @require_axis
+    def search_nn_iter(self, points):
+        """
+        Search the nearest node of each of the given points
+
+        points is an iterable of locations, consumed lazily. Yields one
+        (node, distance) tuple per point, the same as search_nn(point) with
+        the default (squared) distance, or None if the tree is empty.
+        """
+
+        for point in points:
+            yield self._nearest(point)
+
+
+    def search_nn_many(self, points):
+        """
+        Search the nearest node of each of the given points
+
+        Returns the list of the nearest nodes and the list of their (squared)
+        distances, in the order of points.
+        """
+
+        nodes, dists = [], []
+        for node, dist in self.search_nn_iter(points):
+            nodes.append(node)
+            dists.append(dist)
+        return nodes, dists
 
-        # Search the side of the splitting plane that the point is in
-        if point[self.axis] <= split_plane + dist:
-            if self.left is not None:
-                self.left._search_nn_dist(point, dist, results, get_dist)
-        if point[self.axis] >= split_plane - dist:
-            if self.right is not None:
-                self.right._search_nn_dist(point, dist, results, get_dist)
+
+    def _nn_within(self, points, radius, dist):
+        # the distances of the tree are squared, those of dist are not
+        if dist is None:
+            radius = radius * radius
+        for point in points:
+            nearest = self._nearest(point)
+            if nearest is None:
+                yield False
+                continue
+            node, node_dist = nearest
+            if dist is not None:
+                node_dist = dist(node.data, point)
+            yield node_dist <= radius
+
+
+    def any_nn_within(self, points, radius, dist=None):
+        """
+        Tells whether the nearest node of any of the given points is within
+        radius of it, stopping at the first such point
+
+        radius is a distance, not a squared one, as in search_within_iter.
+        Nearest nodes are searched with the squared distance of the tree;
+        dist(node.data, point), if given, is the distance compared to radius,
+        and the squared distance is compared to radius**2 otherwise.
+        """
+
+        return any(self._nn_within(points, radius, dist))
+
+
+    def all_nn_within(self, points, radius, dist=None):
+        """
+        Tells whether the nearest nodes of all the given points are within
+        radius of them (see any_nn_within)
+        """
+
+        return all(self._nn_within(points, radius, dist))
+
+
+    def _within(self, point, radius):
+        # nodes whose squared distance to point is at most radius**2, near
+        # side first; the far side of a node is searched only if its
+        # splitting plane is within radius, which is exact as the squared
+        # distance of a node is at least that of the plane
+        radius2 = radius * radius
+        dimensions = range(self.dimensions)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            data = node.data
+            if data is None:
+                continue
+
+            node_dist = 0
+            for i in dimensions:
+                d = data[i] - point[i]
+                node_dist += d * d
+            if node_dist <= radius2:
+                yield node, node_dist
+
+            plane_dist = point[node.axis] - data[node.axis]
+            if plane_dist < 0:
+                near, far = node.left, node.right
+            else:
+                near, far = node.right, node.left
+            if far is not None and plane_dist * plane_dist <= radius2:
+                stack.append(far)
+            if near is not None:
+                stack.append(near)
+
+
+    @require_axis
+    def search_within_iter(self, point, radius):
+        """
+        Search the nodes within radius of the given point
+
+        radius is a distance, not a squared one: the nodes yielded are those
+        at a squared distance of at most radius**2, as (node, squared
+        distance) tuples, in the order they are found. The search goes on
+        only as long as the iterator is consumed.
+        """
+
+        return self._within(point, radius)
+
+
+    def any_within(self, point, radius):
+        """ Tells whether a node is within radius of point, stopping at the
+        first one found (see search_within_iter) """
+
+        for _ in self.search_within_iter(point, radius):
+            return True
+        return False
+
+
+    def count_within(self, point, radius):
+        """ Number of nodes within radius of point (see search_within_iter) """
+
+        return sum(1 for _ in self.search_within_iter(point, radius))
+
+
+    def search_within(self, point, radius, k=None):
+        """
+        List of the (node, squared distance) tuples of the nodes within radius
+        of point (see search_within_iter)
+
+        With k, the search stops at the first k nodes found, which are not
+        necessarily the nearest ones (see search_knn).
+        """
+
+        return list(itertools.islice(self.search_within_iter(point, radius), k))
 
 
     @require_axis
@@ -519,15 +677,14 @@ class KDNode(Node):
         Search the n nearest nodes of the given point which are within given
         distance
 
-        point must be a location, not a node. A list containing the n nearest
-        nodes to the point within the distance will be returned.
+        point must be a location, not a node. A list containing the data of
+        the nodes at a distance (not squared) less than distance to the point
+        will be returned.
         """
 
-        results = []
-        get_dist = lambda n: n.dist(point)
-
-        self._search_nn_dist(point, distance, results, get_dist)
-        return results
+        distance2 = distance * distance
+        return [node.data for node, d in self.search_within_iter(point, distance)
+                if d < distance2]
 
 
     @require_axis
@@ -573,6 +730,176 @@ class KDNode(Node):
 
 
 
+class DynamicKDNode(KDNode):
+    """ A KDNode whose tree stays balanced as points are added and removed
+
+    Every node counts the points of its subtree. After an update, the
+    highest node on the updated path whose larger subtree holds more than
+    alpha of its points is rebuilt from them, as in a scapegoat tree, so
+    that every subtree stays weight-balanced: the height of a tree of n
+    points is at most log(n) / log(1/alpha) + 1. Rebuilding m points takes
+    O(m log m) time (see create), which makes additions O(log² n) amortized.
+    A removal moves replacement points up from the subtree of the removed
+    node, as KDNode.remove does, down to a leaf which is dropped.
+
+    The methods that update the tree must be called on its root, which stays
+    the root. Trees are created by create_dynamic. """
+
+    alpha = 0.7
+
+
+    def __init__(self, data=None, left=None, right=None, axis=None,
+            sel_axis=None, dimensions=None):
+        super(DynamicKDNode, self).__init__(data, left, right, axis,
+                                            sel_axis, dimensions)
+        self.size = int(data is not None)
+
+
+    def _count(self):
+        # sets the sizes of the subtree, bottom up
+        for node in self.postorder():
+            node.size = 1 + sum(c.size for c, _ in node.children)
+
+
+    def _rebuild(self, exclude=None):
+        # rebuilds the subtree in place, without the node exclude
+        points = [node.data for node in self.inorder() if node is not exclude]
+        if not points:
+            self.data, self.left, self.right, self.size = None, None, None, 0
+            return
+        tree = _create(points, self.dimensions, self.axis, self.sel_axis,
+                       self.__class__)
+        self.data, self.left, self.right = tree.data, tree.left, tree.right
+        self._count()
+
+
+    def _restore(self, path):
+        # rebuilds the highest unbalanced node of path (from the root), if any
+        for node in path:
+            sizes = [c.size for c, _ in node.children]
+            if sizes and max(sizes) > self.alpha * node.size:
+                node._rebuild()
+                return node
+        return None
+
+
+    @require_axis
+    def add(self, point):
+        """
+        Adds a point to the tree, and rebalances it if needed
+
+        Returns the node holding the point.
+        """
+
+        path, current = [], self
+        while True:
+            check_dimensionality([point], dimensions=current.dimensions)
+            path.append(current)
+
+            # Adding has hit an empty leaf-node, add here
+            if current.data is None:
+                current.data = point
+                added = current
+                break
+
+            side = 0 if point[current.axis] < current.data[current.axis] else 1
+            child = current.left if side == 0 else current.right
+            if child is None:
+                added = current.create_subnode(point)
+                current.set_child(side, added)
+                break
+            current = child
+
+        for node in path:
+            node.size += 1
+
+        rebuilt = self._restore(path)
+        if rebuilt is not None:
+            added = next(node for node in rebuilt.preorder()
+                         if node.data is point)
+        return added
+
+
+    def extreme_child(self, sel_func, axis):
+        # as KDNode.extreme_child, but below the nodes splitting on axis only
+        # the side of the extreme point, sel_func(0, 1), is searched
+        side = sel_func(0, 1)
+        best, stack = (None, None), [(self, None)]
+        while stack:
+            node, parent = stack.pop()
+            if not node:
+                continue
+            if best[0] is None or sel_func(
+                    best[0].data[axis], node.data[axis]) != best[0].data[axis]:
+                best = (node, parent)
+            for child, pos in node.children:
+                if node.axis != axis or pos == side:
+                    stack.append((child, node))
+        return best
+
+
+    def _path(self, point, node):
+        # path from the root to the node to remove, or None
+        stack = [[self]]
+        while stack:
+            path = stack.pop()
+            current = path[-1]
+            if not current:
+                continue
+            if current.should_remove(point, node):
+                return path
+
+            axis = current.axis
+            if current.right is not None and point[axis] >= current.data[axis]:
+                stack.append(path + [current.right])
+            if current.left is not None and point[axis] <= current.data[axis]:
+                stack.append(path + [current.left])
+        return None
+
+
+    @require_axis
+    def remove(self, point, node=None):
+        """ Removes the node with the given point from the tree
+
+        Returns the root node, self. If there are multiple points matching
+        "point", only one is removed. The optional "node" parameter is used
+        for checking the identity, once the removeal candidate is decided."""
+
+        path = self._path(point, node)
+        if path is None:
+            return self
+
+        # moves the replacements of the removed point up (see
+        # find_replacement), down to a leaf, which is then dropped
+        removed = path[-1]
+        while not removed.is_leaf:
+            replacement, _ = removed.find_replacement()
+            path.extend(removed._path(replacement.data, replacement)[1:])
+            removed.data = replacement.data
+            removed = replacement
+
+        path.pop()
+        if path:
+            path[-1].set_child(int(path[-1].left is not removed), None)
+        else:
+            removed.data, removed.size = None, 0
+
+        for node in path:
+            node.size -= 1
+        self._restore(path)
+        return self
+
+
+    def rebalance(self):
+        """
+        Rebuilds the tree in place and returns its root, self
+        """
+
+        self._rebuild()
+        return self
+
+
+
 def create(point_list=None, dimensions=None, axis=0, sel_axis=None):
     """ Creates a kd-tree from a list of points
 
@@ -588,6 +915,21 @@ def create(point_list=None, dimensions=None, axis=0, sel_axis=None):
     sel_axis(axis) is used when creating subnodes of a node. It receives the
     axis of the parent node and returns the axis of the child node. """
 
+    return _create(point_list, dimensions, axis, sel_axis, KDNode)
+
+
+def create_dynamic(point_list=None, dimensions=None, axis=0, sel_axis=None):
+    """ Creates a self-balancing kd-tree (see DynamicKDNode) from a list of
+    points, as create """
+
+    tree = _create(point_list, dimensions, axis, sel_axis, DynamicKDNode)
+    tree._count()
+    return tree
+
+
+def _create(point_list, dimensions, axis, sel_axis, node_class):
+    # create(), with nodes of the given KDNode class
+
     if not point_list and not dimensions:
         raise ValueError('either point_list or dimensions must be provided')
 
@@ -598,17 +940,85 @@ def create(point_list=None, dimensions=None, axis=0, sel_axis=None):
     sel_axis = sel_axis or (lambda prev_axis: (prev_axis+1) % dimensions)
 
     if not point_list:
-        return KDNode(sel_axis=sel_axis, axis=axis, dimensions=dimensions)
+        return node_class(sel_axis=sel_axis, axis=axis, dimensions=dimensions)
 
-    # Sort point list and choose median as pivot element
-    point_list = list(point_list)
-    point_list.sort(key=lambda point: point[axis])
-    median = len(point_list) // 2
+    # The subtrees below the root cycle through the axes
+    cycle = lambda prev_axis: (prev_axis+1) % dimensions
 
-    loc   = point_list[median]
-    left  = create(point_list[:median], dimensions, sel_axis(axis))
-    right = create(point_list[median + 1:], dimensions, sel_axis(axis))
-    return KDNode(loc, left, right, axis=axis, sel_axis=sel_axis, dimensions=dimensions)
+    # Each node takes the median of its points, in the order of a stable
+    # sort of its parent's points on its axis: the points are ordered by
+    # their coordinates on the axes of the node and of its ancestors, from
+    # the node up, and then by their position in point_list. The points are
+    # ranked once for each of these orders, and a node selects the median of
+    # its ranks, without sorting nor recursion.
+    point_list = list(point_list)
+    axis_ranks, ranks = {}, {}
+
+    def order_ranks(axes):
+        if axes not in ranks:
+            for a in axes:
+                if a not in axis_ranks:
+                    axis_ranks[a] = _axis_ranks(point_list, a)
+            keys = [axis_ranks[a] for a in reversed(axes)]
+            order = np.lexsort([np.arange(len(point_list))] + keys)
+            ranks[axes] = np.empty(len(order), dtype=np.int64)
+            ranks[axes][order] = np.arange(len(order))
+        return ranks[axes]
+
+    # Small subtrees are built from lists of the ranks of their points,
+    # fetched once per order
+    small = 64
+
+    root = node_class(sel_axis=sel_axis, axis=axis, dimensions=dimensions)
+    stack = [(root, np.arange(len(point_list)), (axis,), None)]
+    while stack:
+        node, indices, axes, local = stack.pop()
+        median = len(indices) // 2
+        if local is None and len(indices) <= small:
+            indices = indices.tolist()
+            local = {None: indices}
+        if local is None:
+            part = np.argpartition(order_ranks(axes)[indices], median)
+            left, right = indices[part[:median]], indices[part[median+1:]]
+            node.data = point_list[indices[part[median]]]
+        else:
+            if axes not in local:
+                rank = order_ranks(axes)[local[None]].tolist()
+                local[axes] = dict(zip(local[None], rank))
+            indices = sorted(indices, key=local[axes].__getitem__)
+            left, right = indices[:median], indices[median+1:]
+            node.data = point_list[indices[median]]
+
+        subaxis = node.sel_axis(node.axis)
+        subaxes = (subaxis,) + tuple(a for a in axes if a != subaxis)
+        for side, sub in ((0, left), (1, right)):
+            child = node_class(axis=subaxis, sel_axis=cycle, dimensions=dimensions)
+            node.set_child(side, child)
+            if len(sub):
+                stack.append((child, sub, subaxes, local))
+
+    return root
+
+
+def _axis_ranks(point_list, axis):
+    """ Dense ranks of the coordinates of the points on the axis """
+
+    try:
+        keys = np.array([point[axis] for point in point_list])
+        if keys.dtype.kind in 'biuf':
+            return np.unique(keys, return_inverse=True)[1]
+    except (TypeError, ValueError):
+        pass
+
+    # other coordinates only need to be comparable
+    order = sorted(range(len(point_list)), key=lambda i: point_list[i][axis])
+    ranks = np.empty(len(order), dtype=np.int64)
+    rank = 0
+    for prev, i in zip([None] + order, order):
+        if prev is not None and point_list[prev][axis] < point_list[i][axis]:
+            rank += 1
+        ranks[i] = rank
+    return ranks
 
 
 def check_dimensionality(point_list, dimensions=None):
@@ -621,6 +1031,351 @@ def check_dimensionality(point_list, dimensions=None):
 
 
 
+StaticNode = namedtuple('StaticNode', 'data index')
+
+
+class StaticKDTree(object):
+    """ A read-only kd-tree stored in contiguous NumPy arrays
+
+    The points are permuted so that every node covers a contiguous range of
+    them, and nodes are laid out implicitly: node i has the children 2i+1
+    and 2i+2, split on the axis of widest spread at the median. Ranges of at
+    most leafsize points are leaf buckets, scanned with vectorized distances.
+
+    Distances are squared Euclidean distances, as KDNode.dist, though
+    computed with products rather than math.pow, which may differ in the
+    last bit. Among points at the same distance of a query, the first in the
+    point list is returned. """
+
+    def __init__(self, point_list, leafsize=16):
+        if not point_list:
+            raise ValueError('a StaticKDTree needs at least one point')
+        self.data = list(point_list)
+        self.dimensions = check_dimensionality(self.data)
+        self.leafsize = leafsize = max(1, leafsize)
+        points = self.project(self.data)
+        self.dimensions = points.shape[1]
+        n = len(points)
+
+        # depth of the tree: the largest half of a node has ceil(size/2) points
+        depth, size = 0, n
+        while size > leafsize:
+            size, depth = size - size // 2, depth + 1
+        nnodes = 2**(depth + 1) - 1
+
+        self.start = np.zeros(nnodes, dtype=np.int64)
+        self.end = np.zeros(nnodes, dtype=np.int64)
+        self.axis = np.full(nnodes, -1, dtype=np.int8)     # -1: leaf or unused
+        self.split = np.zeros(nnodes)
+        self.low = np.full((nnodes, self.dimensions), np.inf)
+        self.high = np.full((nnodes, self.dimensions), -np.inf)
+
+        perm = np.arange(n)
+        stack = [(0, 0, n)]
+        while stack:
+            node, lo, hi = stack.pop()
+            sub = points[perm[lo:hi]]
+            self.start[node], self.end[node] = lo, hi
+            self.low[node], self.high[node] = sub.min(axis=0), sub.max(axis=0)
+            if hi - lo <= leafsize:
+                continue
+            axis = int(np.argmax(self.high[node] - self.low[node]))
+            mid = (lo + hi) // 2
+            perm[lo:hi] = perm[lo:hi][np.argpartition(sub[:, axis], mid - lo)]
+            self.axis[node] = axis
+            self.split[node] = points[perm[mid], axis]
+            stack.append((2*node + 2, mid, hi))
+            stack.append((2*node + 1, lo, mid))
+
+        self.points = np.ascontiguousarray(points[perm])
+        self.indices = perm
+        self._lists = None
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def project(self, points):
+        """ Array of the coordinates of the points in the space of the tree """
+        return np.array(points, dtype=np.float64).reshape(len(points),
+                                                          self.dimensions)
+
+
+    def distance(self, sqdist):
+        """ Distances returned for an array of squared distances in the space
+        of the tree: the squared distances themselves """
+        return sqdist
+
+
+    def _home_leaves(self, queries):
+        # leaf where each query would be inserted
+        node = np.zeros(len(queries), dtype=np.int64)
+        inner = np.flatnonzero(self.axis[node] >= 0)
+        while len(inner):
+            n = node[inner]
+            right = queries[inner, self.axis[n]] >= self.split[n]
+            node[inner] = 2*n + 1 + right
+            inner = inner[self.axis[node[inner]] >= 0]
+        return node
+
+
+    def _scan(self, queries, leaves):
+        # nearest point of each (query, leaf) pair: (distance, index)
+        width = self.end[leaves] - self.start[leaves]
+        rows = self.start[leaves, None] + np.arange(self.leafsize)
+        rows = np.minimum(rows, (self.start[leaves] + width - 1)[:, None])
+        diff = self.points[rows] - queries[:, None, :]
+        dist = (diff * diff).sum(axis=-1)
+        best = dist.min(axis=1)
+        index = np.where(dist == best[:, None], self.indices[rows], len(self.data))
+        return best, index.min(axis=1)
+
+
+    def _lower_bound(self, queries, nodes):
+        # squared distance from each query to the bounding box of its node
+        gap = np.maximum(np.maximum(self.low[nodes] - queries,
+                                    queries - self.high[nodes]), 0)
+        return (gap * gap).sum(axis=-1)
+
+
+    def nearest_many(self, points):
+        """ Nearest point of each of the given points
+
+        Returns the arrays of the indices (in the point list) of the nearest
+        points and of their distances. All queries go down the tree
+        together, level by level: subtrees whose bounding box is further
+        than the point found in the query's own leaf are pruned. """
+
+        queries = self.project(points)
+        nq = len(queries)
+        if not nq:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        bound = self._scan(queries, self._home_leaves(queries))[0]
+
+        qids, nodes = np.arange(nq), np.zeros(nq, dtype=np.int64)
+        leaf_qids, leaf_nodes = [], []
+        while len(qids):
+            leaf = self.axis[nodes] < 0
+            leaf_qids.append(qids[leaf])
+            leaf_nodes.append(nodes[leaf])
+            qids = np.repeat(qids[~leaf], 2)
+            nodes = (2*nodes[~leaf, None] + np.array([1, 2])).ravel()
+            keep = self._lower_bound(queries[qids], nodes) <= bound[qids]
+            qids, nodes = qids[keep], nodes[keep]
+
+        qids, nodes = np.concatenate(leaf_qids), np.concatenate(leaf_nodes)
+        dist, index = self._scan(queries[qids], nodes)
+        order = np.lexsort((index, dist, qids))
+        first = np.unique(qids[order], return_index=True)[1]
+        return index[order][first], self.distance(dist[order][first])
+
+
+    def search_nn(self, point):
+        """
+        (StaticNode, distance) of the nearest point of point
+
+        The search of a single point goes down Python lists copied from the
+        arrays of the tree, as NumPy calls on a few values at a time cost
+        more than they save; the result is that of nearest_many.
+        """
+
+        if self._lists is None:
+            self._lists = (self.axis.tolist(), self.split.tolist(),
+                           self.start.tolist(), self.end.tolist(),
+                           self.points.tolist(), self.indices.tolist())
+        axes, splits, starts, ends, points, indices = self._lists
+        query = self.project([point])[0].tolist()
+
+        best, best_index = float('inf'), len(self.data)
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound > best:
+                continue
+            # down to the leaf of the query, the far sides being searched
+            # afterwards if their splitting plane is close enough
+            axis = axes[node]
+            while axis >= 0:
+                d = query[axis] - splits[node]
+                if d >= 0:
+                    near, far = 2*node + 2, 2*node + 1
+                else:
+                    near, far = 2*node + 1, 2*node + 2
+                stack.append((far, max(bound, d * d)))
+                node = near
+                axis = axes[node]
+            for row in range(starts[node], ends[node]):
+                dist = 0.0
+                for p, q in zip(points[row], query):
+                    dist += (p - q) * (p - q)
+                if dist < best or (dist == best and indices[row] < best_index):
+                    best, best_index = dist, indices[row]
+
+        dist = float(self.distance(np.float64(best)))
+        return StaticNode(self.data[best_index], best_index), dist
+
+
+    def search_nn_iter(self, points, chunksize=64, maxchunksize=4096):
+        """
+        Search the nearest point of each of the given points
+
+        points is an iterable of locations, consumed lazily by chunks of
+        growing size. Yields one (StaticNode, distance) tuple per point, as
+        KDNode.search_nn_iter, whose node data is the point of the list.
+        """
+
+        points = iter(points)
+        while True:
+            chunk = list(itertools.islice(points, chunksize))
+            if not chunk:
+                return
+            index, dist = self.nearest_many(chunk)
+            for i, d in zip(index.tolist(), dist.tolist()):
+                yield StaticNode(self.data[i], i), d
+            chunksize = min(2 * chunksize, maxchunksize)
+
+
+    def search_knn(self, point, k):
+        """ Return the k nearest neighbors of point and their distances
+
+        The result is an ordered list of (StaticNode, distance) tuples, as
+        KDNode.search_knn, of at most k points: of the points at the same
+        distance, the first ones of the point list. Nodes are visited best
+        first, by the distance of the query to their bounding box. """
+
+        if k < 1:
+            raise ValueError("k must be greater than 0.")
+
+        query = self.project([point])
+        best = []       # heap of the (-distance, -index) of the k best points
+        nodes = [(0.0, 0)]
+        while nodes:
+            bound, node = heapq.heappop(nodes)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            if self.axis[node] >= 0:
+                children = np.array([2*node + 1, 2*node + 2])
+                bounds = self._lower_bound(query, children)
+                for bound, child in zip(bounds.tolist(), children.tolist()):
+                    heapq.heappush(nodes, (bound, child))
+                continue
+            rows = slice(self.start[node], self.end[node])
+            diff = self.points[rows] - query
+            dists = (diff * diff).sum(axis=-1)
+            for d, i in zip(dists.tolist(), self.indices[rows].tolist()):
+                if len(best) < k:
+                    heapq.heappush(best, (-d, -i))
+                elif (-d, -i) > best[0]:
+                    heapq.heapreplace(best, (-d, -i))
+
+        best.sort(reverse=True)
+        dists = self.distance(np.array([-d for d, _ in best])).tolist()
+        return [(StaticNode(self.data[-i], -i), d)
+                for (_, i), d in zip(best, dists)]
+
+
+    def sqradius(self, radius):
+        """ Squared distance in the space of the tree of a radius """
+        return radius * radius
+
+
+    def search_within_iter(self, point, radius):
+        """
+        Search the points within radius of the given point
+
+        Yields the (StaticNode, distance) tuples of the points at a distance
+        of at most radius, one leaf bucket at a time, nearest boxes first.
+        The search goes on only as long as the iterator is consumed.
+        """
+
+        query = self.project([point])
+        radius2 = self.sqradius(radius)
+        if self._lower_bound(query, np.array([0]))[0] > radius2:
+            return
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.axis[node] >= 0:
+                children = np.array([2*node + 1, 2*node + 2])
+                bounds = self._lower_bound(query, children)
+                for bound, child in sorted(zip(bounds.tolist(), children.tolist()),
+                                           reverse=True):
+                    if bound <= radius2:
+                        stack.append(child)
+                continue
+            rows = slice(self.start[node], self.end[node])
+            diff = self.points[rows] - query
+            dists = (diff * diff).sum(axis=-1)
+            found = np.flatnonzero(dists <= radius2)
+            if len(found):
+                index = self.indices[rows][found].tolist()
+                for i, d in zip(index, self.distance(dists[found]).tolist()):
+                    yield StaticNode(self.data[i], i), d
+
+
+    def any_within(self, point, radius):
+        """ Tells whether a point is within radius of point, stopping at the
+        first one found (see search_within_iter) """
+
+        for _ in self.search_within_iter(point, radius):
+            return True
+        return False
+
+
+    def count_within(self, point, radius):
+        """ Number of points within radius of point """
+
+        return sum(1 for _ in self.search_within_iter(point, radius))
+
+
+    def search_within(self, point, radius, k=None):
+        """
+        List of the (StaticNode, distance) tuples of the points within radius
+        of point, or of the first k found (see search_within_iter)
+        """
+
+        return list(itertools.islice(self.search_within_iter(point, radius), k))
+
+
+EARTH_RADIUS = 6371000
+
+
+class GeoKDTree(StaticKDTree):
+    """ A StaticKDTree of (lat, lon) points, in degrees, with distances in
+    meters along the great circles of a spherical Earth
+
+    The points are indexed by their (x, y, z) positions on the unit sphere,
+    whose chord lengths grow with the great-circle distances: the nearest
+    points by chord are the nearest points in meters, found without
+    comparing degrees of latitude and longitude. The chord lengths c found
+    are converted to distances 2 R asin(c/2), which are the haversine
+    distances of query.distance up to rounding. The radii of the searches
+    within a radius are in meters as well. Points may have more fields after
+    their latitude and longitude. """
+
+    geodesic = True
+
+    def project(self, points):
+        latlon = np.radians(np.array([(p[0], p[1]) for p in points],
+                                     dtype=np.float64).reshape(-1, 2))
+        lat, lon = latlon[:, 0], latlon[:, 1]
+        return np.column_stack((np.cos(lat) * np.cos(lon),
+                                np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+    def distance(self, sqdist):
+        """ Great-circle distances (m) of an array of squared chord lengths """
+        return 2 * EARTH_RADIUS * np.arcsin(np.minimum(np.sqrt(sqdist) / 2, 1))
+
+
+    def sqradius(self, radius):
+        """ Squared chord length of a great-circle distance (m) """
+        radius = min(max(radius, 0), math.pi * EARTH_RADIUS)
+        return (2 * math.sin(radius / (2 * EARTH_RADIUS)))**2
+
+
+
 def level_order(tree, include_all=False):
     """ Returns an iterator over the tree in level-order
 
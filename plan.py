@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""Declarative query plans over GPS traces
+
+A plan is a list of record filters -- time window, spatial box, proximity
+to reference objects -- followed by a test on the records that remain: at
+least m records, all of them within a box, a fast pair of records, a
+continuous batch (see query.continuous_batches), or a long enough stay (see
+query.lingered). The queries q1..q10 of query.py are written as plans in
+beijing_plans and give the same answers.
+
+optimize() rewrites a plan before it runs: time windows are pushed to the
+front, where binslice only takes a slice of the trace, consecutive windows
+and boxes are merged, and a box or proximity filter directly followed by an
+"at least" test is fused with it. compile_plan() then picks the operators:
+the kernels of vectorized.py over the records, and with evaluate_fleet, the
+grid index (gridindex.py) or the hour index (tracestore.HourIndex) of the
+fleet when the plan allows it.
+"""
+
+from collections import namedtuple
+
+import vectorized
+from query import (DAY, HOUR, MINUTE, c1, c2, d1, d2, delta_B,
+                   binslice, closest_objects, close_within, is_fleet,
+                   is_materialized, is_within, lingered, load, load_vehicle,
+                   poi_index, vehicle_file, vehicles, within_distance_kdtree,
+                   windowed_load, q1, q2, q3, q4, q5, q6, q7, q8, q9, q10)
+import gridindex
+
+### Plans
+
+## Filters
+TimeWindow = namedtuple("TimeWindow", "t0 t1")
+SpatialBox = namedtuple("SpatialBox", "p1 p2")
+NearObjects = namedtuple("NearObjects", "objects maxdist")
+
+## Tests
+AtLeast = namedtuple("AtLeast", "m")
+StayedIn = namedtuple("StayedIn", "p1 p2")
+FastPair = namedtuple("FastPair", "minspeed delta")
+Continuous = namedtuple("Continuous", "maxgap minspan nb_records minspeed")
+Continuous.__new__.__defaults__ = (1, None)
+Lingered = namedtuple("Lingered", "delta mintime")
+
+Plan = namedtuple("Plan", "filters test")
+
+beijing_plans = {
+    q1: Plan([TimeWindow(8*HOUR, 12*HOUR)], AtLeast(1)),
+    q2: Plan([NearObjects("parkings.csv", 50)], AtLeast(1)),
+    q3: Plan([TimeWindow(17*HOUR, 18*HOUR)],
+             Continuous(delta_B[1], delta_B[0], 1)),
+    q4: Plan([SpatialBox(c1, c2)], AtLeast(1)),
+    q5: Plan([TimeWindow(17*HOUR, 18*HOUR)], FastPair(89, 15)),
+    q6: Plan([TimeWindow(0, DAY)], Continuous(10, 10*MINUTE, 1, 42)),
+    q7: Plan([SpatialBox(d1, d2), TimeWindow(0, DAY)],
+             Continuous(delta_B[1], delta_B[0], 1)),
+    q8: Plan([TimeWindow(17*HOUR, 18*HOUR), SpatialBox(c1, c2)], AtLeast(1)),
+    q9: Plan([TimeWindow(12*HOUR, 13*HOUR)], StayedIn(c1, c2)),
+    q10: Plan([NearObjects("fuels.csv", 50)], Lingered(10, 60)),
+}
+
+### Optimizer
+
+def commutes_with_window(f):
+    # a window gives the same records before or after f. Near filters keep
+    # the records as they are; box filters keep (t, lat, lon) only, which
+    # binslice compares to (t0,0,0) the same way unless a record is at
+    # (0, 0) exactly, hence boxes not containing (0, 0)
+    if isinstance(f, NearObjects):
+        return True
+    return isinstance(f, SpatialBox) and not is_within(0, 0, f.p1, f.p2)
+
+def merge(f1, f2):
+    # single filter equivalent to f1 then f2, or None
+    if isinstance(f1, TimeWindow) and isinstance(f2, TimeWindow):
+        return TimeWindow(max(f1.t0, f2.t0), min(f1.t1, f2.t1))
+    if isinstance(f1, SpatialBox) and isinstance(f2, SpatialBox):
+        return SpatialBox((min(f1.p1[0], f2.p1[0]), max(f1.p1[1], f2.p1[1])),
+                          (max(f1.p2[0], f2.p2[0]), min(f1.p2[1], f2.p2[1])))
+    return None
+
+def optimize(plan):
+    """ Equivalent plan with the time windows first, and with consecutive
+    windows and consecutive boxes merged """
+    filters = []
+    for f in plan.filters:
+        i = len(filters)
+        if isinstance(f, TimeWindow):
+            while i > 0 and commutes_with_window(filters[i-1]):
+                i -= 1
+        if i > 0 and merge(filters[i-1], f):
+            filters[i-1] = merge(filters[i-1], f)
+        else:
+            filters.insert(i, f)
+    return Plan(filters, plan.test)
+
+### Operators
+
+def window_operator(f):
+    return lambda data: binslice(data, f.t0, f.t1)
+
+def box_operator(f):
+    return lambda data: vectorized.space_filter(data, f.p1, f.p2)
+
+def near_operator(f):
+    close = close_within(f.maxdist)
+    def near(data):
+        return [rec for rec, obj in closest_objects(data, poi_index(f.objects))
+                if close(rec[1],rec[2],obj[0],obj[1])]
+    return near
+
+def test_operator(test):
+    if isinstance(test, AtLeast):
+        return lambda data: len(data) >= test.m
+    if isinstance(test, StayedIn):
+        return lambda data: vectorized.stayed_in(data, test.p1, test.p2)
+    if isinstance(test, FastPair):
+        return lambda data: bool(
+            (vectorized.speeds(data, test.delta) >= test.minspeed).any())
+    if isinstance(test, Continuous):
+        def continuous(data):
+            dt, _, speeds = vectorized.steps(data)
+            valid = dt <= test.maxgap
+            if test.minspeed is not None:
+                valid &= speeds >= test.minspeed
+            starts, ends = vectorized.batches(vectorized.times(data), valid,
+                                              test.minspan, test.nb_records)
+            return len(starts) > 0
+        return continuous
+    if isinstance(test, Lingered):
+        return lambda data: lingered((rec[0] for rec in data),
+                                     test.delta, test.mintime)
+    raise ValueError('unknown test %r' % (test,))
+
+def fused_operator(f, test):
+    # a box or near filter ending with an "at least" test, in one operator
+    if isinstance(f, SpatialBox) and isinstance(test, AtLeast):
+        def count_within(data):
+            t, lat, lon = vectorized.columns(data)
+            return int(vectorized.is_within(lat, lon, f.p1, f.p2).sum()) >= test.m
+        return count_within
+    if isinstance(f, NearObjects) and test == AtLeast(1):
+        return lambda data: within_distance_kdtree(data, f.objects, f.maxdist)
+    return None
+
+filter_operators = {TimeWindow: window_operator, SpatialBox: box_operator,
+                    NearObjects: near_operator}
+
+def compile_plan(plan):
+    """ Function of the records (a list or a Trace; other iterables are
+    materialized first) evaluating the optimized plan """
+    plan = optimize(plan)
+    filters = list(plan.filters)
+    test = fused_operator(filters[-1], plan.test) if filters else None
+    if test:
+        filters.pop()
+    else:
+        test = test_operator(plan.test)
+    stages = [filter_operators[type(f)](f) for f in filters]
+
+    def evaluate(data):
+        if not is_materialized(data):
+            data = list(data)
+        for stage in stages:
+            data = stage(data)
+        return test(data)
+    return evaluate
+
+def evaluate(plan, data):
+    return compile_plan(plan)(data)
+
+### Fleet evaluation
+
+def evaluate_fleet(plan, folder, grid=None, hours=None, loadf=load):
+    """ Answers of the plan for the vehicles of folder, in their order
+
+    With a GridIndex of the folder, plans reduced to a box and an "at least
+    one" test, or to a "stayed in" test, use the index; with an HourIndex of
+    a directory, plans starting with a time window only read its hours. """
+    plan = optimize(plan)
+    if grid is not None and plan.filters == [] and isinstance(plan.test, StayedIn):
+        return gridindex.stayed_in_fleet(grid, folder, plan.test.p1,
+                                         plan.test.p2, loadf)
+    if (grid is not None and len(plan.filters) == 1 and
+        isinstance(plan.filters[0], SpatialBox) and plan.test == AtLeast(1)):
+        return gridindex.passed_by_fleet(grid, folder, plan.filters[0].p1,
+                                         plan.filters[0].p2, loadf)
+    run = compile_plan(plan)
+    window = plan.filters[0] if plan.filters else None
+    if (hours is not None and not is_fleet(folder) and
+        isinstance(window, TimeWindow)):
+        return [run(windowed_load(hours, vehicle_file(folder, vehicle),
+                                  window.t0, window.t1, loadf))
+                for vehicle in vehicles(folder)]
+    return [run(load_vehicle(folder, vehicle, loadf)) for vehicle in vehicles(folder)]
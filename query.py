@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
-from os import listdir, makedirs, remove, rename
-from os.path import isdir, join, exists
-from sys import argv
+from os import listdir, makedirs, remove, rename, stat, devnull
+from os.path import isdir, join, exists, abspath
+from sys import argv, getsizeof
 from time import process_time
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
+import pickle
+from hashlib import sha1
 
 from bisect import bisect_right as binsearch
 from math import radians, sin, cos, atan2, sqrt
-from itertools import chain
+from itertools import chain, islice, takewhile, dropwhile, tee
 import kdtree
+import vectorized
+from tracestore import Trace, HourIndex, concat, parse
 
 ### Constants
 
@@ -34,40 +41,222 @@ def load_day(filename, day):
             data.append(tuple(record))
         return data
 
+def iterload(filename):
+    # lazy load: records are parsed only as far as they are consumed
+    with open(filename, "r") as file:
+        for line in file:
+            if line.strip():
+                yield tuple(map(float,line.strip().split(",")))
+
 def load_days(filename, basefolder):
     with open(filename, "r") as file:
         lines = file.readlines()
+        if is_fleet(basefolder):
+            return concat([basefolder.load(line.rstrip('\n')) for line in lines],
+                          [i*DAY for i in range(len(lines))])
         return list(chain(*[load_day(join(basefolder, lines[i].rstrip('\n')), i)
                               for i in range(len(lines))]))
 
-### Query over a folder
+## Bulk variants -- whole files parsed by NumPy into a Trace (tracestore.py)
+
+def bulk_load(filename):
+    return parse(filename)
+
+def bulk_load_day(filename, day):
+    return parse(filename, day*DAY)
+
+def bulk_load_days(filename, basefolder):
+    with open(filename, "r") as file:
+        lines = file.readlines()
+        return concat([parse(join(basefolder, line.rstrip('\n'))) for line in lines],
+                      [i*DAY for i in range(len(lines))])
+
+### Process-wide parse cache
+# Parsed traces are kept under (path, mtime, size), so that a file modified
+# on disk is parsed again; least recently used traces are evicted once the
+# estimated size of the cached traces exceeds maxbytes.
+
+def sizeof_trace(data):
+    if isinstance(data, Trace):
+        return sum(column.nbytes for column in data.columns())
+    if not data:
+        return getsizeof(data)
+    return getsizeof(data) + len(data) * (getsizeof(data[0]) +
+                                          sum(getsizeof(x) for x in data[0]))
+
+class TraceCache(object):
+    def __init__(self, maxbytes=512*2**20, loadf=load):
+        self.maxbytes, self.loadf = maxbytes, loadf
+        self.traces = OrderedDict()
+        self.nbytes = self.hits = self.misses = 0
+
+    def load(self, filename):
+        st = stat(filename)
+        key = (abspath(filename), st.st_mtime_ns, st.st_size)
+        if key in self.traces:
+            self.hits += 1
+            self.traces.move_to_end(key)
+            return self.traces[key][0]
+        self.misses += 1
+        data = self.loadf(filename)
+        size = sizeof_trace(data)
+        if size <= self.maxbytes:
+            self.traces[key] = (data, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self.traces.popitem(last=False)[1][1]
+        return data
 
-def apply_query(folder, Q, *args):
-    return [Q(load(join(folder,file)),*args) for file in sorted(listdir(folder))]
+    def clear(self):
+        self.traces.clear()
+        self.nbytes = 0
 
-def query(folder, Q, *args):
-    files = sorted(listdir(folder))
-    return sum(Q(load(join(folder,file)),*args) for file in files)/len(files)
+trace_cache = TraceCache()
 
-def querydays(basefolder, daysfolder, Q, *args):
-    files = sorted(listdir(daysfolder))
-    return sum(Q(load_days(join(daysfolder,file), basefolder),*args)
-               for file in files)/len(files)
+def cached_load(filename):
+    return trace_cache.load(filename)
 
-def queryall(Q, filename, basefolder, mindays, load_function=load, *args):
+### Folders of traces -- a directory, or a fleet object with the listdir() and
+### load(vehicle) methods: TraceStore or CompactFleet (tracestore.py)
+
+def is_fleet(folder):
+    return not isinstance(folder, str)
+
+def vehicles(folder):
+    if is_fleet(folder):
+        return folder.listdir()
+    return sorted(listdir(folder))
+
+def vehicle_file(folder, vehicle):
+    return vehicle if is_fleet(folder) else join(folder, vehicle)
+
+def load_vehicle(folder, vehicle, loadf=load):
+    if is_fleet(folder):
+        return folder.load(vehicle)
+    return loadf(join(folder, vehicle))
+
+### Query over a folder
+# With workers=n, vehicles (or day lists) are evaluated by a pool of n
+# processes, in chunks; results keep the order of the folder listing, so that
+# lists and averages are identical to the sequential ones. Q and its
+# arguments must then be picklable (module-level functions, not lambdas),
+# and a memo gets the new results of the worker processes once they are done.
+
+def pool_map(f, items, workers=None, chunksize=None):
+    if not workers or workers == 1 or len(items) <= 1:
+        return [f(item) for item in items]
+    chunksize = chunksize or max(1, len(items) // (4*workers))
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(f, items, chunksize=chunksize))
+
+def _vehicle_answer(folder, Q, args, file):
+    return Q(load_vehicle(folder,file),*args)
+
+def _days_answer(basefolder, Q, args, file):
+    return Q(load_days(file, basefolder),*args)
+
+def _ndays_answer(basefolder, Q, mindays, loadf, args, memo, file):
+    return queryall(Q, file, basefolder, mindays, loadf, *args, memo=memo)
+
+def _ndays_memo_answer(basefolder, Q, mindays, loadf, args, memo, file):
+    # evaluates with a memo of its own over the results of memo, and returns
+    # the answer with the new results and counts, for QueryMemo.merge
+    local = QueryMemo()
+    local.results = ChainMap({}, memo.results)
+    res = queryall(Q, file, basefolder, mindays, loadf, *args, memo=local)
+    return res, local.results.maps[0], local.hits, local.misses
+
+def apply_query(folder, Q, *args, workers=None):
+    return pool_map(partial(_vehicle_answer, folder, Q, args),
+                    vehicles(folder), workers)
+
+def query(folder, Q, *args, workers=None):
+    files = vehicles(folder)
+    return sum(pool_map(partial(_vehicle_answer, folder, Q, args),
+                        files, workers))/len(files)
+
+def querydays(basefolder, daysfolder, Q, *args, workers=None):
+    files = [join(daysfolder,file) for file in sorted(listdir(daysfolder))]
+    return sum(pool_map(partial(_days_answer, basefolder, Q, args),
+                        files, workers))/len(files)
+
+def queryall(Q, filename, basefolder, mindays, load_function=load, *args,
+             memo=None):
     with open(filename, "r") as file:
         satisfyingdays = 0
         for line in file.readlines():
-            if Q(load_function(join(basefolder,line[:-1])),*args):
+            if memo is not None:
+                res = memo.evaluate(Q, args, basefolder, line[:-1], load_function)
+            else:
+                res = Q(load_vehicle(basefolder,line[:-1],load_function),*args)
+            if res:
                 satisfyingdays += 1
             if satisfyingdays >= mindays:
                 return True
         return False
 
-def queryndays(basefolder, daysfolder, Q, mindays=1, loadf=load, *args):
-    files = sorted(listdir(daysfolder))
-    return sum(queryall(Q, join(daysfolder, file), basefolder, mindays,
-                        loadf, *args) for file in files)/len(files)
+def queryndays(basefolder, daysfolder, Q, mindays=1, loadf=load, *args,
+               memo=None, workers=None):
+    files = [join(daysfolder,file) for file in sorted(listdir(daysfolder))]
+    if memo is not None and workers and workers > 1:
+        answers = pool_map(partial(_ndays_memo_answer, basefolder, Q, mindays,
+                                   loadf, args, memo),
+                           files, workers)
+        return sum(memo.merge(*answer) for answer in answers)/len(files)
+    return sum(pool_map(partial(_ndays_answer, basefolder, Q, mindays, loadf,
+                                args, memo),
+                        files, workers))/len(files)
+
+### Per-day memoization of query answers
+# Inflated datasets (see churn.inflate_data) list the same day files many
+# times: the answer of Q on a day is kept under (query, parameters, identity
+# of the day file) and optionally saved to filename to persist across runs.
+# Queries without a stable name (lambdas, closures) are never memoized.
+
+class QueryMemo(object):
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.results = {}
+        self.hits = self.misses = 0
+        if filename and exists(filename):
+            with open(filename, "rb") as file:
+                self.results = pickle.load(file)
+
+    def key(self, Q, args, basefolder, day):
+        name = getattr(Q, "__module__", "") + "." + getattr(Q, "__qualname__", "<lambda>")
+        if "<" in name:
+            return None
+        if is_fleet(basefolder):
+            if getattr(basefolder, "filename", None) is None:
+                return None     # in-memory fleet, without a file identity
+            path, dayname = abspath(basefolder.filename), day
+        else:
+            path, dayname = abspath(join(basefolder, day)), None
+        st = stat(path)
+        return (name, repr(args), path, dayname, st.st_mtime_ns, st.st_size)
+
+    def evaluate(self, Q, args, basefolder, day, loadf=load):
+        key = self.key(Q, args, basefolder, day)
+        if key is None:
+            return Q(load_vehicle(basefolder, day, loadf), *args)
+        if key in self.results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.results[key] = Q(load_vehicle(basefolder, day, loadf), *args)
+        return self.results[key]
+
+    def merge(self, answer, results, hits, misses):
+        # adds the results and counts of a worker memo, returns its answer
+        self.results.update(results)
+        self.hits += hits
+        self.misses += misses
+        return answer
+
+    def save(self):
+        with open(self.filename + ".tmp", "wb") as file:
+            pickle.dump(self.results, file)
+        rename(self.filename + ".tmp", self.filename)
 
 ### Kd-tree & Distance
 
@@ -77,34 +266,126 @@ def distance(lat1, lon1, lat2, lon2):
          cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2) * sin(dlon/2))
     return 6371000 * 2 * atan2(sqrt(a), sqrt(1 - a))
 
+## Distance predicates -- close_within(maxdist)(lat1,lon1,lat2,lon2) tells
+## whether distance(lat1,lon1,lat2,lon2) <= maxdist, with the haversine only
+## computed when cheaper bounds cannot decide
+# The distance is at least the one between the parallels, R*|dlat|. When
+# |dlat| and |dlon| are below MAXSEP radians (about 6 km) and the mean
+# latitude below 84 degrees (cos >= 0.1), the equirectangular distance
+# R*sqrt(dlat^2 + (cos(mean lat)*dlon)^2) is within a relative error
+# (dlat^2 + dlon^2)/cos(mean lat)^2 <= CLOSE_REL of it (the largest error
+# measured is 2% of that bound); 1e-9 relative and absolute margins cover
+# rounding. Only points within that error of maxdist, or with latitudes out
+# of [-90, 90], get the haversine.
+
+MAXSEP = 0.001
+M_PER_DEG = 6371000 * radians(1)
+CLOSE_REL = 2 * MAXSEP**2 / 0.1**2 + 1e-9
+
+def close_within(maxdist):
+    margin = 1e-9 * maxdist + 1e-9
+    ylim = maxdist + margin
+    seplim = 6371000 * MAXSEP
+    true2 = ((maxdist - margin) / (1 + CLOSE_REL))**2 if maxdist > margin else -1
+    false2 = ((maxdist + margin) / (1 - CLOSE_REL))**2
+    halfrad = radians(1) / 2
+
+    def is_close(lat1, lon1, lat2, lon2):
+        if abs(lat1) <= 90 and abs(lat2) <= 90:
+            y = (lat2 - lat1) * M_PER_DEG
+            if abs(y) > ylim:
+                return False
+            x = (lon2 - lon1) * M_PER_DEG
+            if abs(x) <= seplim and abs(y) <= seplim:
+                cosm = cos((lat1 + lat2) * halfrad)
+                if cosm >= 0.1:
+                    x *= cosm
+                    d2 = x*x + y*y
+                    if d2 <= true2:
+                        return True
+                    if d2 > false2:
+                        return False
+        return distance(lat1,lon1,lat2,lon2) <= maxdist
+    return is_close
+
+## Reference objects (parkings, fuel stations, ...) -- one static kd-tree per file,
+## built on first use and rebuilt when the file changes
+
+class POIRegistry(object):
+    def __init__(self, build=kdtree.StaticKDTree, loadf=load):
+        self.build, self.loadf = build, loadf
+        self.trees = {}
+        self.builds = 0
+
+    def get(self, filename):
+        st = stat(filename)
+        path, version = abspath(filename), (st.st_mtime_ns, st.st_size)
+        if path not in self.trees or self.trees[path][0] != version:
+            self.builds += 1
+            self.trees[path] = (version, self.build(self.loadf(filename)))
+        return self.trees[path][1]
+
+    def clear(self):
+        self.trees.clear()
+
+poi_registry = POIRegistry()
+
+def poi_index(objects):
+    """ kd-tree of the reference objects: objects itself, or the shared tree
+    of the file of that name """
+    return poi_registry.get(objects) if isinstance(objects, str) else objects
+
 def dist_closest(lat,lon,kdtree):
-    objlat, objlon = kdtree.search_nn((lat,lon))[0].data
+    # a geodesic tree (kdtree.GeoKDTree) finds the closest object in meters
+    node, dist = kdtree.search_nn((lat,lon))
+    if getattr(kdtree, "geodesic", False):
+        return dist
+    objlat, objlon = node.data
     return distance(lat,lon,objlat,objlon)
 
+def closest_objects(data, kdtree):
+    # (record, closest object) pairs, the objects being searched in bulk for
+    # lists of records; records of an iterator are searched one at a time,
+    # as static trees search their points by chunks and would read ahead
+    if not is_materialized(data):
+        return ((rec, kdtree.search_nn((rec[1],rec[2]))[0].data) for rec in data)
+    records, points = tee(data)
+    closest = kdtree.search_nn_iter((rec[1],rec[2]) for rec in points)
+    return ((rec, node.data) for rec, (node, _) in zip(records, closest))
+
 def within_distance_kdtree(data, kdtree, maxdist):
-    return any(dist_closest(rec[1],rec[2],kdtree) <= maxdist for rec in data)
+    kdtree = poi_index(kdtree)
+    close = close_within(maxdist)
+    return any(close(rec[1],rec[2],objlat,objlon)
+               for rec, (objlat, objlon) in closest_objects(data, kdtree))
 
 def passed_closeby_nobjects(data, kdtree, maxdist, ntimes):
+    kdtree = poi_index(kdtree)
+    close = close_within(maxdist)
     passedby = set()
-    for rec in data:
-        t, lat, lon = rec[0], rec[1], rec[2]
-        objlat, objlon = kdtree.search_nn((lat,lon))[0].data
+    for rec, (objlat, objlon) in closest_objects(data, kdtree):
+        lat, lon = rec[1], rec[2]
         if ( (objlat, objlon) not in passedby and
-             distance(lat,lon,objlat,objlon) <= maxdist ):
+             close(lat,lon,objlat,objlon) ):
             passedby.add((objlat, objlon))
             if len(passedby) == ntimes:
                 return True
     return False
      
 def has_refilled_tank_old(data, kdtree, maxdist=50, delta=10, mintime=60):
+    kdtree = poi_index(kdtree)
+    close = close_within(maxdist)
     def close_points():
-        for rec in data:
+        for rec, (objlat, objlon) in closest_objects(data, kdtree):
             t, lat, lon = rec[0], rec[1], rec[2]
-            objlat, objlon = kdtree.search_nn((lat,lon))[0].data
-            if distance(lat,lon,objlat,objlon) <= maxdist:
+            if close(lat,lon,objlat,objlon):
                 yield t
+    return lingered(close_points(), delta, mintime)
+
+def lingered(times, delta=10, mintime=60):
+    # some run of times, with gaps of at most delta, lasts at least mintime
     ts = t1 = None
-    for t in close_points():
+    for t in times:
         if ts and (t-t1) <= delta:
             if (t-ts) >= mintime:
                 return True 
@@ -114,13 +395,17 @@ def has_refilled_tank_old(data, kdtree, maxdist=50, delta=10, mintime=60):
     return False
 
 def stopped_close2object(data, objects, maxdist=10, duration=600, maxpseed=0):
-    def stop(r1, r2):
-        if instant_speed(r1, r2) <= maxpseed:
-           objlat, objlon = objects.search_nn((r1[1],r1[2]))[0].data
-           if distance(r1[1],r1[2],objlat,objlon) <= maxdist:
-               return True
-        return False
-    for batch in continuous_batches(data, duration, stop):
+    # pair j, (data[j], data[j+1]), is a stop if the vehicle is slow and
+    # data[j+1] close to an object; objects are searched in bulk, only for
+    # the slow pairs
+    objects = poi_index(objects)
+    slow = [j for j, s in enumerate(vectorized.steps(data)[2].tolist())
+            if s <= maxpseed]
+    close = close_within(maxdist)
+    stops = [False] * max(len(data)-1, 0)
+    for j, (rec, obj) in zip(slow, closest_objects([data[j+1] for j in slow], objects)):
+        stops[j] = close(rec[1],rec[2],obj[0],obj[1])
+    for batch in continuous_batches(data, duration, stops):
         return True
     return False
 
@@ -156,6 +441,12 @@ def space_filter(data, p1, p2):
             if is_within(rec[1],rec[2],p1,p2)]
 
 def continuous(data, validator):
+    # validator(rec2, rec1) tells whether consecutive records rec1, rec2 are
+    # in the same batch; it may also be the precomputed sequence of these
+    # answers, where validator[j] is for (data[j], data[j+1])
+    if not callable(validator):
+        yield from continuous_pairs(data, validator)
+        return
     i = 0
     while i < len(data):
         j = i
@@ -165,12 +456,34 @@ def continuous(data, validator):
             yield data[i:j]
         i = j+1
 
+def continuous_pairs(data, valid):
+    starts, ends = vectorized.runs(valid)
+    for i, j in zip(starts.tolist(), ends.tolist()):
+        yield data[i:j]
+
 def continuous_batches(data, minspan, validator, t0=0, t1=DAY, nb_records=1):
-    yield from (sub for sub in continuous(binslice(data,t0,t1), validator)
+    lo, hi = binsearch(data, (t0,0,0)), binsearch(data, (t1,0,0))
+    if not callable(validator):
+        # precomputed validities: segmentation and filters over whole arrays
+        window = data[lo:hi]
+        starts, ends = vectorized.batches(vectorized.times(window),
+                                          validator[lo:max(hi-1,lo)],
+                                          minspan, nb_records)
+        yield from (window[i:j] for i, j in zip(starts.tolist(), ends.tolist()))
+        return
+    yield from (sub for sub in continuous(data[lo:hi], validator)
                 if len(sub) >= nb_records and (sub[-1][0]-sub[0][0]) >= minspan)
 
+def is_materialized(data):
+    # records whose pairs can be precomputed by the kernels of vectorized.py
+    return isinstance(data, (list, Trace))
+
 def has_continuous_data(data, t0=0, t1=DAY, maxd=float("inf"), minspan=0, m=1):
-    within_delay = lambda d1, d2 : abs(d1[0]-d2[0]) <= maxd
+    if is_materialized(data):
+        data = binslice(data,t0,t1)
+        within_delay = vectorized.time_steps(data) <= maxd
+    else:
+        within_delay = lambda d1, d2 : abs(d1[0]-d2[0]) <= maxd
     for batch in continuous_batches(data,minspan,within_delay,t0,t1,m):
         return True
     return False
@@ -181,6 +494,9 @@ def instant_speed(rec1, rec2):
     return 3.6*distance(rec1[1],rec1[2],rec2[1],rec2[2]) / abs(rec2[0]-rec1[0])
 
 def speed(data, delta=15):
+    if is_materialized(data):
+        yield from vectorized.speeds(data, delta).tolist()
+        return
     record1 = None
     for record2 in data:
         if record1 and abs(record2[0]-record1[0]) <= delta:
@@ -188,7 +504,7 @@ def speed(data, delta=15):
         record1 = record2
 
 def stopped(data, duration=600, maxspeed=0):
-    stop = lambda r1, r2: instant_speed(r1, r2) <= maxspeed
+    stop = vectorized.steps(data)[2] <= maxspeed
     for batch in continuous_batches(data, duration, stop):
         return True
     return False
@@ -198,7 +514,8 @@ def average_speed(data):
     return sum(speeds)/len(speeds) if speeds else None
 
 
-## Queries from the paper Q1 to Q10 -- Beijing dataset; loading included
+## Queries from the paper Q1 to Q10 -- Beijing dataset
+## (they take a trace; short_queries wraps them to load it themselves)
 
 delta_B = (80, 5)
 
@@ -206,8 +523,7 @@ def q1(data, t0=8*HOUR, t1=12*HOUR, m=1):
     return has_enough_data(data, t0, t1, m)
 
 def q2(data, parkingsfile="parkings.csv", maxdist=50):
-    parkingstree = kdtree.create(load(parkingsfile))
-    return within_distance_kdtree(data, parkingstree, maxdist)
+    return within_distance_kdtree(data, poi_index(parkingsfile), maxdist)
 
 def q3(data, t0=17*HOUR, t1=18*HOUR, tau=delta_B[0], delta=delta_B[1], m=1):
     return has_continuous_data(data, t0, t1, delta, tau, m)
@@ -219,9 +535,8 @@ def q5(data, maxspeed=89, t0=17*HOUR, t1=18*HOUR):
     return any(s >= maxspeed for s in speed(binslice(data,t0,t1))) 
 
 def q6(data, minspeed=42, tau=10*MINUTE, delta=10):
-    for b in continuous_batches(data, tau,
-         lambda rec1, rec2 : instant_speed(rec1, rec2) >= minspeed
-            and abs(rec2[0]-rec1[0]) <= delta):
+    dt, _, speeds = vectorized.steps(data)
+    for b in continuous_batches(data, tau, (speeds >= minspeed) & (dt <= delta)):
         return True
     return False
 
@@ -235,50 +550,429 @@ def q9(data, p1=c1, p2=c2):
     return stayed_in(binslice(data,12*HOUR,13*HOUR), p1, p2)
 
 def q10(data, fuelsfile="fuels.csv", maxdist=50):
-    fueltree = kdtree.create(load(fuelsfile))
-    return has_refilled_tank_old(data, fueltree, maxdist)
+    return has_refilled_tank_old(data, poi_index(fuelsfile), maxdist)
+
+
+## Lazy variants -- over record iterators such as iterload(file) ##
+# Evaluation stops reading at the record deciding the answer; answers are the
+# same as the list-based versions above. passed_by, within_distance_kdtree,
+# passed_closeby_nobjects and has_refilled_tank_old already consume their
+# records lazily, and so do q2, q4 and q10.
+# eg short_queries([lazy_q1, q2, lazy_q3, ...], iterload)
+
+def lazy_binslice(records, t0, t1):
+    lo, hi = (t0,0,0), (t1,0,0)     # same bounds as binslice
+    return takewhile(lambda rec: rec <= hi,
+                     dropwhile(lambda rec: rec <= lo, records))
+
+def lazy_has_enough_data(records, t0=0, t1=DAY, nb_records=1):
+    return sum(1 for _ in islice(lazy_binslice(records,t0,t1),
+                                 max(nb_records,0))) >= nb_records
+
+def lazy_stayed_in(records, p1, p2):
+    empty = True
+    for rec in records:
+        if not is_within(rec[1],rec[2],p1,p2):
+            return False
+        empty = False
+    return not empty
+
+def lazy_space_filter(records, p1, p2):
+    return ((rec[0],rec[1],rec[2]) for rec in records
+            if is_within(rec[1],rec[2],p1,p2))
+
+def lazy_continuous(records, validator):
+    # same batches as continuous, including the exclusion of the last record
+    run = []
+    for rec in records:
+        if run and not validator(rec, run[-1]):
+            if len(run) > 1:
+                yield run[:-1]
+            run = []
+        run.append(rec)
+    if len(run) > 1:
+        yield run[:-1]
+
+def lazy_continuous_batches(records, minspan, validator, t0=0, t1=DAY,
+                            nb_records=1):
+    yield from (sub for sub in
+                lazy_continuous(lazy_binslice(records,t0,t1), validator)
+                if len(sub) >= nb_records and (sub[-1][0]-sub[0][0]) >= minspan)
+
+def lazy_has_continuous_data(records, t0=0, t1=DAY, maxd=float("inf"),
+                             minspan=0, m=1):
+    within_delay = lambda d1, d2 : abs(d1[0]-d2[0]) <= maxd
+    for batch in lazy_continuous_batches(records,minspan,within_delay,t0,t1,m):
+        return True
+    return False
+
+def lazy_q1(records, t0=8*HOUR, t1=12*HOUR, m=1):
+    return lazy_has_enough_data(records, t0, t1, m)
+
+def lazy_q3(records, t0=17*HOUR, t1=18*HOUR, tau=delta_B[0], delta=delta_B[1],
+            m=1):
+    return lazy_has_continuous_data(records, t0, t1, delta, tau, m)
+
+def lazy_q5(records, maxspeed=89, t0=17*HOUR, t1=18*HOUR):
+    return any(s >= maxspeed for s in speed(lazy_binslice(records,t0,t1)))
+
+def lazy_q6(records, minspeed=42, tau=10*MINUTE, delta=10):
+    for b in lazy_continuous_batches(records, tau,
+         lambda rec1, rec2 : instant_speed(rec1, rec2) >= minspeed
+            and abs(rec2[0]-rec1[0]) <= delta):
+        return True
+    return False
+
+def lazy_q7(records, p1=d1, p2=d2, tau=delta_B[0], delta=delta_B[1], t0=0,
+            t1=DAY):
+    return lazy_has_continuous_data(lazy_space_filter(records,p1,p2),
+                                    t0, t1, delta, tau, 1)
+
+def lazy_q8(records, p1=c1, p2=c2, t0=17*HOUR, t1=18*HOUR):
+    return passed_by(lazy_binslice(records,t0,t1), p1, p2)
+
+def lazy_q9(records, p1=c1, p2=c2):
+    return lazy_stayed_in(lazy_binslice(records,12*HOUR,13*HOUR), p1, p2)
+
+
+## Vectorized variants -- over the columns of the records (vectorized.py) ##
+# Best on Trace records (bulk_load, TraceStore, CompactFleet), whose columns
+# are used without conversion.
+
+def vec_q4(data, p1=c1, p2=c2):
+    return vectorized.passed_by(data, p1, p2)
+
+def vec_q5(data, maxspeed=89, t0=17*HOUR, t1=18*HOUR):
+    return bool((vectorized.speeds(binslice(data,t0,t1)) >= maxspeed).any())
+
+def vec_q8(data, p1=c1, p2=c2, t0=17*HOUR, t1=18*HOUR):
+    return vectorized.passed_by(binslice(data,t0,t1), p1, p2)
+
+def vec_q9(data, p1=c1, p2=c2):
+    return vectorized.stayed_in(binslice(data,12*HOUR,13*HOUR), p1, p2)
+
+
+## Fused evaluation of a battery of queries on one trace ##
+# The window bounds, the columns, the (dt, dist, speed) steps of the pairs and
+# the box masks of a trace are computed once, by the first query needing them,
+# and reused by the others: q1..q10 then cost about one scan of the trace.
+# The cost of a shared sub-result is split evenly among the queries using it.
+
+class SharedTrace(object):
+    def __init__(self, data):
+        self.data = data
+        self.values, self.costs, self.users = {}, {}, {}
+        self.query, self.spent = None, 0
+
+    def get(self, key, f, *args):
+        # f(*args), computed once; the arguments are evaluated by the caller,
+        # so that nested sub-results are not charged twice
+        if key not in self.values:
+            start = process_time()
+            self.values[key] = f(*args)
+            self.costs[key] = 1000 * (process_time() - start)
+            self.spent += self.costs[key]
+        self.users.setdefault(key, set()).add(self.query)
+        return self.values[key]
+
+    def share(self, query):
+        # compute time (ms) of the sub-results used by query, split evenly
+        # among the queries using them
+        return sum(self.costs[key] / len(users)
+                   for key, users in self.users.items() if query in users)
+
+    def bounds(self, t0, t1):
+        return self.get(("bounds", t0, t1), lambda: (
+            binsearch(self.data, (t0,0,0)), binsearch(self.data, (t1,0,0))))
+
+    def columns(self):
+        return self.get("columns", vectorized.columns, self.data)
+
+    def steps(self):
+        return self.get("steps", vectorized.steps, self.data)
+
+    def within(self, p1, p2):
+        t, lat, lon = self.columns()
+        return self.get(("within", p1, p2), vectorized.is_within,
+                        lat, lon, p1, p2)
+
+def fused_q1(shared, t0=8*HOUR, t1=12*HOUR, m=1):
+    lo, hi = shared.bounds(t0, t1)
+    return max(hi - lo, 0) >= m
+
+def fused_q3(shared, t0=17*HOUR, t1=18*HOUR, tau=delta_B[0], delta=delta_B[1], m=1):
+    lo, hi = shared.bounds(t0, t1)
+    t = shared.columns()[0]
+    dt = shared.steps()[0]
+    starts, ends = vectorized.batches(t[lo:hi], dt[lo:max(hi-1,lo)] <= delta,
+                                      tau, m)
+    return len(starts) > 0
+
+def fused_q4(shared, p1=c1, p2=c2):
+    return bool(shared.within(p1, p2).any())
+
+def fused_q5(shared, maxspeed=89, t0=17*HOUR, t1=18*HOUR):
+    lo, hi = shared.bounds(t0, t1)
+    dt, _, speeds = shared.steps()
+    dt, speeds = dt[lo:max(hi-1,lo)], speeds[lo:max(hi-1,lo)]
+    return bool((speeds[dt <= 15] >= maxspeed).any())
+
+def fused_q6(shared, minspeed=42, tau=10*MINUTE, delta=10):
+    lo, hi = shared.bounds(0, DAY)
+    t = shared.columns()[0]
+    dt, _, speeds = shared.steps()
+    valid = (speeds >= minspeed) & (dt <= delta)
+    starts, ends = vectorized.batches(t[lo:hi], valid[lo:max(hi-1,lo)], tau)
+    return len(starts) > 0
+
+def fused_q7(shared, p1=d1, p2=d2, tau=delta_B[0], delta=delta_B[1], t0=0, t1=DAY):
+    t, lat, lon = shared.columns()
+    mask = shared.within(p1, p2)
+    filtered = list(zip(t[mask].tolist(), lat[mask].tolist(), lon[mask].tolist()))
+    return has_continuous_data(filtered, t0, t1, delta, tau, 1)
+
+def fused_q8(shared, p1=c1, p2=c2, t0=17*HOUR, t1=18*HOUR):
+    lo, hi = shared.bounds(t0, t1)
+    return bool(shared.within(p1, p2)[lo:hi].any())
+
+def fused_q9(shared, p1=c1, p2=c2):
+    lo, hi = shared.bounds(12*HOUR, 13*HOUR)
+    return hi > lo and bool(shared.within(p1, p2)[lo:hi].all())
+
+fused_queries = {q1: fused_q1, q3: fused_q3, q4: fused_q4, q5: fused_q5,
+                 q6: fused_q6, q7: fused_q7, q8: fused_q8, q9: fused_q9}
+
+def evaluate_battery(data, queries, fused=fused_queries):
+    """ Answers of the queries on the records and their compute times (ms)
+
+    Queries of fused are evaluated by their fused version, over sub-results
+    shared with the others; the remaining ones (q2 and q10, whose kd-trees
+    differ) take the records. The time of a query is its own compute time
+    plus its share of the sub-results it uses. """
+    shared = SharedTrace(data)
+    results, own = [], []
+    for q in queries:
+        shared.query, spent = q, shared.spent
+        start = process_time()
+        results.append(fused[q](shared) if q in fused else q(data))
+        own.append(1000 * (process_time() - start) - (shared.spent - spent))
+    return results, [t + shared.share(q) for q, t in zip(queries, own)]
 
 
 ## Generate "time.dat" and "q.dat" files ##
 
-def generate_time_q_files(folder, queries, qntimes, outtime, outq):
-    with open(outtime, 'w') as filetime:
-        with open(outq, 'w') as fileresolution:
-            for vehicle in sorted(listdir(folder)):
-                print(vehicle, end=",", file=filetime)
-                print(vehicle, end=",", file=fileresolution)
-                for i in range(len(queries)):
-                    qtime = 0
-                    for _ in range(qntimes):
-                        start = process_time()
-                        res = queries[i](join(folder,vehicle))
-                        qtime += 1000 * (process_time() - start)
-                    print(round(qtime/qntimes,2), end=',', file=filetime)
-                    print(int(res), end=',', file=fileresolution)
-                print(file=filetime)
-                print(file=fileresolution)
-
-def short_queries(queries):
-    return [(lambda qf: lambda file: qf(load(file)))(q) for q in queries]
+def time_q_row(folder, vehicle, queries, qntimes, loadf=None, fused=False):
+    # queries take the vehicle file and load it themselves (see short_queries);
+    # when loadf is given, they take the trace returned by loadf instead, and
+    # the load time is returned apart rather than charged to the query. Fused
+    # queries always take the trace, loaded with load by default
+    if fused:
+        return fused_time_q_row(folder, vehicle, queries, qntimes,
+                                loadf or (folder.load if is_fleet(folder) else load))
+    times, results, loadtimes = [], [], []
+    for i in range(len(queries)):
+        qtime = ltime = 0
+        for _ in range(qntimes):
+            start = process_time()
+            if loadf:
+                data = loadf(vehicle_file(folder,vehicle))
+                loaded = process_time()
+                ltime += 1000 * (loaded - start)
+                start = loaded
+                res = queries[i](data)
+            else:
+                res = queries[i](vehicle_file(folder,vehicle))
+            qtime += 1000 * (process_time() - start)
+        times.append(round(qtime/qntimes,2))
+        results.append(int(res))
+        loadtimes.append(round(ltime/qntimes,2))
+    return times, results, loadtimes
+
+def fused_time_q_row(folder, vehicle, queries, qntimes, loadf):
+    # the trace is loaded once per repetition for the whole battery (see
+    # evaluate_battery); its load time is split evenly among the queries
+    times, ltime = [0] * len(queries), 0
+    for _ in range(qntimes):
+        start = process_time()
+        data = loadf(vehicle_file(folder,vehicle))
+        ltime += 1000 * (process_time() - start)
+        results, qtimes = evaluate_battery(data, queries)
+        times = [a + b for a, b in zip(times, qtimes)]
+    return ([round(t/qntimes,2) for t in times], [int(r) for r in results],
+            [round(ltime/qntimes/len(queries),2)] * len(queries))
+
+def format_row(vehicle, values):
+    return ",".join(map(str, (vehicle,) + tuple(values))) + ",\n"
+
+def generate_time_q_files(folder, queries, qntimes, outtime, outq,
+                          loadf=None, outload=None, fused=False):
+    with open(outtime, 'w') as filetime, open(outq, 'w') as fileresolution, \
+         open(outload or devnull, 'w') as fileload:
+        for vehicle in vehicles(folder):
+            row = time_q_row(folder, vehicle, queries, qntimes, loadf, fused)
+            for values, file in zip(row, (filetime, fileresolution, fileload)):
+                file.write(format_row(vehicle, values))
+
+## Incremental update of "time.dat" and "q.dat" files ##
+# manifestfile lists "vehicle,mtime_ns,size,sha1" for the traces the files
+# were computed from (size is the number of records and mtime_ns -1 for fleet
+# objects), after a "#config,mode,query names..." line. Only new or modified
+# traces are evaluated again: the other rows are copied as they are, rows of
+# removed traces are dropped, and rows stay in the sorted order of vehicles
+# (see sim.compare_internal_file_order). Every trace is evaluated again when
+# the evaluation mode or the queries change.
+
+def trace_digest(data):
+    digest = sha1()
+    if isinstance(data, Trace):
+        for column in data.columns():
+            digest.update(column.tobytes())
+    else:
+        digest.update(repr(list(data)).encode())
+    return digest.hexdigest()
+
+def file_digest(filename):
+    digest = sha1()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def trace_identity(folder, vehicle, known=None):
+    # known: identity from the manifest, whose digest is reused when the
+    # file keeps the same mtime and size
+    if is_fleet(folder):
+        data = folder.load(vehicle)
+        return (-1, len(data), trace_digest(data))
+    st = stat(join(folder, vehicle))
+    if known and known[:2] == (st.st_mtime_ns, st.st_size):
+        return known
+    return (st.st_mtime_ns, st.st_size, file_digest(join(folder, vehicle)))
+
+def read_rows(filename):
+    rows = {}
+    if filename and exists(filename):
+        with open(filename, "r") as file:
+            for line in file:
+                rows[line.split(",", 1)[0]] = line
+    return rows
+
+def manifest_config(queries, loadf=None, fused=False):
+    mode = "fused" if fused else ("loaded" if loadf else "inline")
+    return ("#config", mode) + tuple(getattr(q, "__name__", repr(q)) for q in queries)
+
+def read_manifest(filename):
+    # (config, {vehicle: identity}); config is None for older manifests
+    manifest, config = {}, None
+    for vehicle, line in read_rows(filename).items():
+        if vehicle == "#config":
+            config = tuple(line.rstrip(",\n").split(","))
+            continue
+        mtime, size, digest = line.rstrip(",\n").split(",")[1:4]
+        manifest[vehicle] = (int(mtime), int(size), digest)
+    return config, manifest
+
+def update_time_q_files(folder, queries, qntimes, outtime, outq, manifestfile,
+                        loadf=None, outload=None, fused=False):
+    """ Updates the files of generate_time_q_files for the traces that
+    changed since manifestfile was written; returns the evaluated vehicles """
+    config, manifest = read_manifest(manifestfile)
+    newconfig = manifest_config(queries, loadf, fused)
+    if config != newconfig:
+        manifest = {}
+    outfiles = [f for f in (outtime, outq, outload) if f]
+    oldrows = [read_rows(f) for f in outfiles]
+    updated, newrows = [], [[] for _ in outfiles]
+    newmanifest = [",".join(newconfig) + ",\n"]
+    for vehicle in vehicles(folder):
+        identity = trace_identity(folder, vehicle, manifest.get(vehicle))
+        rows = [r.get(vehicle) for r in oldrows]
+        if (identity[2] != manifest.get(vehicle, (None,)*3)[2] or None in rows
+            or any(r.count(",") != len(queries) + 1 for r in rows)):
+            updated.append(vehicle)
+            row = time_q_row(folder, vehicle, queries, qntimes, loadf, fused)
+            rows = [format_row(vehicle, values)
+                    for values in (row if outload else row[:2])]
+        for new, line in zip(newrows, rows):
+            new.append(line)
+        newmanifest.append(format_row(vehicle, identity))
+
+    for filename, lines in zip(outfiles + [manifestfile], newrows + [newmanifest]):
+        with open(filename + ".tmp", "w") as file:
+            file.writelines(lines)
+        rename(filename + ".tmp", filename)
+    return updated
+
+def short_queries(queries, loadf=load):
+    # the wrappers keep the names of their queries (see manifest_config)
+    return [(lambda qf: wraps(qf)(lambda file: qf(loadf(file))))(q)
+            for q in queries]
 
 ## short queries generation ##
 
-def gen_beijing_timeq_files(folder, timefilename='time.dat', qfilename='q.dat'):
+def gen_beijing_timeq_files(folder, timefilename='time.dat', qfilename='q.dat',
+                            loadtimefilename=None, manifestfilename=None,
+                            fused=False):
+    # by default every query parses its trace again, and timefilename gets
+    # the load and evaluation times; with loadtimefilename, the trace is
+    # loaded apart, again for each query, and timefilename gets the
+    # evaluation times only; with manifestfilename, only the rows of modified
+    # traces are computed; with fused, the queries share their sub-results
+    # (see evaluate_battery)
+    loadf = folder.load if is_fleet(folder) else load
+    queries = [q1,q2,q3,q4,q5,q6,q7,q8,q9,q10]
+    if not (loadtimefilename or fused):
+        queries, loadf = short_queries(queries, loadf), None
+    if manifestfilename:
+        return update_time_q_files(folder, queries, 3, timefilename, qfilename,
+                                   manifestfilename, loadf, loadtimefilename,
+                                   fused)
+    generate_time_q_files(folder, queries, 3, timefilename, qfilename,
+                          loadf, loadtimefilename, fused)
+
+
+## time-windowed short queries ##
+# With an HourIndex of the folder (tracestore.build_hour_index), the queries
+# restricted to a time window by binslice only read the hours of that window.
+
+beijing_windows = {q1: (8*HOUR, 12*HOUR), q3: (17*HOUR, 18*HOUR),
+                   q5: (17*HOUR, 18*HOUR), q8: (17*HOUR, 18*HOUR),
+                   q9: (12*HOUR, 13*HOUR)}
+
+def windowed_load(index, file, t0, t1, loadf=load):
+    # files missing from the index, or modified since, are loaded in full
+    if index.check(file):
+        return index.load(file, t0, t1)
+    return loadf(file)
+
+def windowed_queries(queries, index, windows=beijing_windows, loadf=load):
+    return [(lambda qf, w: (lambda file: qf(windowed_load(index, file, *w, loadf)))
+                           if w else (lambda file: qf(loadf(file))))
+            (q, windows.get(q)) for q in queries]
+
+def gen_beijing_windowed_timeq_files(folder, indexfile, timefilename='time.dat',
+                                     qfilename='q.dat'):
     generate_time_q_files(folder,
-                          short_queries([q1,q2,q3,q4,q5,q6,q7,q8,q9,q10]),
+        windowed_queries([q1,q2,q3,q4,q5,q6,q7,q8,q9,q10], HourIndex(indexfile)),
                           3, timefilename, qfilename)
 
 
 ## long queries generation ##
 
-def long_queries(queries, nbdays, basefolder):
-    return [(lambda qf, m: lambda file: queryall(qf, file, basefolder, m))
+def long_queries(queries, nbdays, basefolder, memo=None):
+    return [(lambda qf, m: lambda file: queryall(qf, file, basefolder, m,
+                                                 memo=memo))
             (queries[i],nbdays[i]) for i in range(len(queries))]
 
 def gen_beijing_longtimeq_files(folder, basefolder,
                                 timefilename='longtime.dat',
-                                qfilename='longq.dat'):
+                                qfilename='longq.dat', memofilename=None):
+    # with memofilename, each query is evaluated once per distinct day file
+    # (across vehicles, repetitions and runs): times then exclude re-evaluations
+    memo = QueryMemo(memofilename) if memofilename else None
     generate_time_q_files(folder,
-        long_queries([q1,q3,q4,q5,q6,q7,q8], [18,10,8,6,5,4,4], basefolder),
+        long_queries([q1,q3,q4,q5,q6,q7,q8], [18,10,8,6,5,4,4], basefolder,
+                     memo),
                           3, timefilename, qfilename)
-
+    if memo:
+        memo.save()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+### Build the hour index of the day csv files ###
+# Byte offsets of each hour in each file, so that time-windowed queries only
+# read the hours they look at (see query.gen_beijing_windowed_timeq_files).
+
+import sys
+sys.path.append('../../')
+
+from tracestore import build_hour_index
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", type=str, nargs="?", default="../../datasets/beijing",
+                        help="Directory containing the day csv files")
+    parser.add_argument("indexfile", type=str, nargs="?", default="../../datasets/beijing.hours",
+                        help="Hour index to create")
+
+    args = parser.parse_args()
+
+    print("Indexing the dataset...", end="", flush=True)
+    build_hour_index(args.folder, args.indexfile)
+    print("\tDone.")
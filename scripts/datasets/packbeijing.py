@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+### Pack the day csv files into a single memory-mapped trace store ###
+# One-time conversion: query.py can then run from the store (see tracestore.py)
+# without parsing the csv files again.
+
+import sys
+sys.path.append('../../')
+
+from tracestore import pack, TraceStore
+from vectorized import pack_derived_store
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", type=str, nargs="?", default="../../datasets/beijing",
+                        help="Directory containing the day csv files")
+    parser.add_argument("storefile", type=str, nargs="?", default="../../datasets/beijing.trs",
+                        help="Packed trace store to create")
+    parser.add_argument("--derived", action="store_true",
+                        help="Also precompute the derived columns (speeds, "
+                             "step distances, headings) of the traces")
+
+    args = parser.parse_args()
+
+    print("Packing the dataset...", end="", flush=True)
+    pack(args.folder, args.storefile)
+    print("\tDone ({} vehicles).".format(len(TraceStore(args.storefile))))
+    if args.derived:
+        print("Computing derived columns...", end="", flush=True)
+        pack_derived_store(args.storefile)
+        print("\tDone.")
@@ -0,0 +1,44 @@
+## compare the csv parser of query.py with the NumPy bulk parser (tracestore.parse)
+
+import sys
+sys.path.append('../../')
+sys.path.append('../datasets/')
+from os import listdir
+from os.path import join
+from time import perf_counter
+
+from query import load, bulk_load
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument("folder", nargs="?", type=str, default=None, help="Folder of day csv files. Default: paths.beijing_folder")
+parser.add_argument("-r", "--repetitions", default=3, type=int, help="Number of passes over the folder. Default: 3")
+
+args = parser.parse_args()
+
+if args.folder is None:
+    from paths import beijing_folder
+    args.folder = beijing_folder
+
+files = [join(args.folder, file) for file in sorted(listdir(args.folder))]
+
+def timeit(loadf):
+    best = float("inf")
+    for _ in range(args.repetitions):
+        start = perf_counter()
+        for file in files:
+            loadf(file)
+        best = min(best, perf_counter() - start)
+    return best
+
+print("checking that both parsers give the same records...")
+nbrecords = 0
+for file in files:
+    records = load(file)
+    assert list(bulk_load(file)) == records, f"records differ in {file}"
+    nbrecords += len(records)
+
+print(f"{len(files)} files, {nbrecords} records, best of {args.repetitions} passes")
+for name, loadf in [("load", load), ("bulk_load", bulk_load)]:
+    duration = timeit(loadf)
+    print(f"{name:>10}: {round(duration,3)} s, {round(nbrecords/duration)} records/s")
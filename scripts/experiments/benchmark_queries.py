@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+## benchmark the Beijing queries q1..q10 (see benchmark.py): JSON report, and
+## optionally the legacy time.dat and q.dat files
+
+import sys
+sys.path.append('../../')
+sys.path.append('../datasets/')
+
+from benchmark import benchmark_beijing, STATS
+from tracestore import TraceStore
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument("folder", nargs="?", type=str, default=None, help="Folder of day csv files, or a packed .trs store. Default: paths.beijing_folder")
+parser.add_argument("-o", "--output", default="benchmark.json", type=str, help="JSON report. Default: benchmark.json")
+parser.add_argument("-r", "--repeat", default=5, type=int, help="Timed runs per vehicle. Default: 5")
+parser.add_argument("-w", "--warmup", default=1, type=int, help="Untimed runs before them. Default: 1")
+parser.add_argument("-m", "--memory", action="store_true", help="Also measure peak memory (one extra run)")
+parser.add_argument("--legacy", nargs=2, metavar=("TIMEFILE", "QFILE"), default=None, help="Also write time.dat and q.dat files")
+
+args = parser.parse_args()
+
+if args.folder is None:
+    from paths import beijing_folder
+    args.folder = beijing_folder
+folder = TraceStore(args.folder) if args.folder.endswith(".trs") else args.folder
+
+timefile, qfile = args.legacy or (None, None)
+report = benchmark_beijing(folder, args.output, timefile, qfile,
+                           args.repeat, args.warmup, args.memory)
+
+print(f"{len(report['vehicles'])} vehicles, {args.repeat} runs after {args.warmup} warmup")
+print(f"{'':>6}" + "".join(f"{s:>10}" for s in STATS) + "   (ms, summed over vehicles)")
+names = ["load"] + report["config"]["queries"]
+for i, name in enumerate(names):
+    entries = [v["load"] if i == 0 else v["queries"][i-1]["evaluate"] for v in report["vehicles"]]
+    print(f"{name:>6}" + "".join(f"{round(sum(e[s] for e in entries), 2):>10}" for s in STATS))
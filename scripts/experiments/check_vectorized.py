@@ -0,0 +1,65 @@
+## cross-check the NumPy templates (vectorized.py) against query.py, and time both
+## (query.py on lists of records, vectorized.py on Trace columns). query.speed
+## uses vectorized.py on lists too, so speeds are checked against its
+## record-by-record path, over an iterator of the records
+
+import sys
+sys.path.append('../../')
+sys.path.append('../datasets/')
+from os import listdir
+from os.path import join
+from time import perf_counter
+
+import query
+import vectorized
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument("folder", nargs="?", type=str, default=None, help="Folder of day csv files. Default: paths.beijing_folder")
+
+args = parser.parse_args()
+
+if args.folder is None:
+    from paths import beijing_folder
+    args.folder = beijing_folder
+
+def record_speed(data, delta=15):
+    return list(query.speed(iter(data), delta))
+
+def record_q5(data, maxspeed=89, t0=17*query.HOUR, t1=18*query.HOUR):
+    return any(s >= maxspeed for s in record_speed(query.binslice(data,t0,t1)))
+
+boxes = [(query.b1, query.b2), (query.c1, query.c2), (query.d1, query.d2)]
+templates = ["passed_by", "stayed_in", "allrec_outside_zone", "space_filter"]
+queries = [("q4", query.q4, query.vec_q4), ("q5", record_q5, query.vec_q5),
+           ("q8", query.q8, query.vec_q8), ("q9", query.q9, query.vec_q9)]
+
+durations = {}
+def timed(name, f, *a):
+    start = perf_counter()
+    res = f(*a)
+    durations[name] = durations.get(name, 0) + perf_counter() - start
+    return res
+
+maxerror = 0
+for file in sorted(listdir(args.folder)):
+    records = query.load(join(args.folder, file))
+    trace = query.bulk_load(join(args.folder, file))
+    for name in templates:
+        for p1, p2 in boxes:
+            expected = timed(name, getattr(query, name), records, p1, p2)
+            assert getattr(vectorized, name)(records, p1, p2) == expected, \
+                   f"{name} differs on {file}"
+            assert timed("vec_" + name, getattr(vectorized, name), trace, p1, p2) == expected, \
+                   f"{name} differs on {file}"
+    for name, q, vec_q in queries:
+        expected = timed(name, q, records)
+        assert timed("vec_" + name, vec_q, trace) == expected, f"{name} differs on {file}"
+    expected = timed("speed", record_speed, records)
+    speeds = timed("vec_speed", vectorized.speeds, trace).tolist()
+    assert len(speeds) == len(expected), f"speed differs on {file}"
+    maxerror = max([maxerror] + [abs(a-b) for a, b in zip(speeds, expected)])
+
+print("all answers agree; largest speed difference:", maxerror, "km/h")
+for name in templates + [name for name, _, _ in queries] + ["speed"]:
+    print(f"{name:>20}: {round(durations[name],3)} s, vectorized {round(durations['vec_'+name],3)} s")
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+"""Columnar storage for vehicle traces
+
+A Trace exposes the (t, lat, lon, alt) record interface that the query
+templates of query.py expect from load(), but it is backed by one array per
+column. A TraceStore packs a whole fleet folder into a single file that is
+memory-mapped on opening: loading a vehicle then returns a Trace of views on
+the mapped columns, without any parsing, and with the derived columns of a
+companion file (see pack_derived) when there is one. A CompactFleet keeps a fleet in
+memory (or in a file) with 16 bytes per record, decoding a vehicle's Trace
+only when it is loaded. An HourIndex locates the hours of
+the csv traces of a folder, so that a time window is read without the rest
+of the file.
+"""
+
+import json
+from hashlib import sha1
+from os import listdir, remove, stat
+from os.path import join, basename, exists
+
+import numpy as np
+
+COLUMNS = ("t", "lat", "lon", "alt")
+
+### Record interface over columns
+
+class Trace(object):
+    """ Sequence of (t, lat, lon, alt) records stored column-wise
+
+    Indexing returns a record tuple of Python floats, as load() does, and
+    slicing returns a Trace of views on the same columns.
+
+    derived maps names to tuples of columns derived from the consecutive
+    pairs of records, pair j being (trace[j], trace[j+1]); it is filled on
+    first use by vectorized.py, and slices get the matching pairs. """
+
+    __slots__ = COLUMNS + ("derived",)
+
+    def __init__(self, t, lat, lon, alt, derived=None):
+        self.t, self.lat, self.lon, self.alt = t, lat, lon, alt
+        self.derived = {} if derived is None else derived
+
+    @classmethod
+    def from_records(cls, records):
+        """ Builds a Trace from a list of record tuples (see query.load) """
+        if not records:
+            return cls(*np.empty((len(COLUMNS), 0)))
+        return cls(*np.array(records, dtype=np.float64).T[:len(COLUMNS)])
+
+    def columns(self):
+        return (self.t, self.lat, self.lon, self.alt)
+
+    def __len__(self):
+        return len(self.t)
+
+    def __bool__(self):
+        return len(self.t) > 0
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            derived = {}
+            if step == 1 and self.derived:
+                pairs = slice(start, max(stop - 1, start))
+                derived = {name: tuple(c[pairs] for c in columns)
+                           for name, columns in self.derived.items()}
+            return self.__class__(*(c[i] for c in self.columns()),
+                                  derived=derived)
+        return (self.t.item(i), self.lat.item(i),
+                self.lon.item(i), self.alt.item(i))
+
+    def __iter__(self):
+        return zip(*(c.tolist() for c in self.columns()))
+
+    def __repr__(self):
+        return '<%s - %d records>' % (self.__class__.__name__, len(self))
+
+
+def parse(filename, offset=0, ncolumns=len(COLUMNS)):
+    """ Parses a csv trace file into a Trace
+
+    The whole file is converted by NumPy's C parser in one call, and offset
+    is added to the timestamps as a single vectorized operation. Values are
+    the ones float() gives, so the records equal those of query.load. """
+    with open(filename, "rb") as file:
+        values = np.fromstring(file.read().replace(b",", b" "), sep=" ")
+    columns = np.ascontiguousarray(values.reshape(-1, ncolumns).T)
+    if offset:
+        columns[0] += offset
+    return Trace(*columns)
+
+
+def concat(traces, offsets):
+    """ Concatenates traces, shifting the timestamps of traces[i] by
+    offsets[i] (see query.load_days) """
+    if not traces:
+        return Trace.from_records([])
+    return Trace(np.concatenate([tr.t + off for tr, off in zip(traces, offsets)]),
+                 *(np.concatenate(cols) for cols in
+                   zip(*((tr.lat, tr.lon, tr.alt) for tr in traces))))
+
+
+### Packed fleet file
+#
+# layout: MAGIC | header length (uint64) | json header | padding |
+#         t[n] | lat[n] | lon[n] | alt[n]          (little-endian float64)
+#
+# The json header lists the vehicles (sorted file names of the packed folder)
+# and the n+1 row offsets delimiting each vehicle in the columns, and the
+# sha1 digest of the columns, which identifies the packed data.
+
+MAGIC = b"DLVNTRS1"
+ALIGN = 64
+
+def _data_offset(headerlen):
+    end = len(MAGIC) + 8 + headerlen
+    return end + (-end % ALIGN)
+
+def _nb_records(filename):
+    with open(filename, "r") as file:
+        return sum(1 for line in file if line.strip())
+
+def pack(folder, storefile, loadf=parse):
+    """ Packs every trace file of folder into the single file storefile
+
+    This is a one-time conversion: the traces are parsed with loadf and
+    never again afterwards. The derived file storefile + ".derived" of a
+    previous packing, if any, is removed. """
+    vehicles = sorted(listdir(folder))
+    offsets = [0]
+    for vehicle in vehicles:
+        offsets.append(offsets[-1] + _nb_records(join(folder, vehicle)))
+    n = offsets[-1]
+    if exists(storefile + ".derived"):
+        remove(storefile + ".derived")
+
+    def write_header(file, digest):
+        header = json.dumps({"vehicles": vehicles, "offsets": offsets,
+                             "digest": digest}).encode()
+        file.write(MAGIC)
+        file.write(np.uint64(len(header)).astype("<u8").tobytes())
+        file.write(header)
+        return _data_offset(len(header))
+
+    # the digest is written once the columns are, in place of a placeholder
+    # of the same length
+    with open(storefile, "wb") as file:
+        base = write_header(file, "0" * 40)
+        file.write(b"\0" * (base - file.tell()))
+        file.truncate(base + len(COLUMNS) * 8 * n)
+    digest = sha1()
+    if n:
+        columns = np.memmap(storefile, dtype="<f8", mode="r+", offset=base,
+                            shape=(len(COLUMNS), n))
+        for i, vehicle in enumerate(vehicles):
+            trace = loadf(join(folder, vehicle))
+            if not isinstance(trace, Trace):
+                trace = Trace.from_records(trace)
+            for column, values in zip(columns, trace.columns()):
+                column[offsets[i]:offsets[i+1]] = values
+        columns.flush()
+        for column in columns:
+            digest.update(column.tobytes())
+        del columns
+    with open(storefile, "r+b") as file:
+        write_header(file, digest.hexdigest())
+
+
+### Derived columns of a packed fleet
+#
+# layout: DERIVED_MAGIC | header length (uint64) | json header | padding |
+#         one float64 column of n rows per derived column
+#
+# The json header repeats the vehicles, offsets and digest of the store, and
+# lists the [name, width] of the derived columns (see Trace.derived). Pair j of a
+# vehicle is stored at row offsets[i] + j: the last row of a vehicle is left
+# at zero.
+
+DERIVED_MAGIC = b"DLVNDRV1"
+
+def _read_header(filename, magic, kind):
+    with open(filename, "rb") as file:
+        if file.read(len(magic)) != magic:
+            raise ValueError('%s is not a %s' % (filename, kind))
+        headerlen = int(np.frombuffer(file.read(8), dtype="<u8")[0])
+        return json.loads(file.read(headerlen).decode()), _data_offset(headerlen)
+
+def pack_derived(store, derivedfile, derive, names):
+    """ Writes the derived columns of every trace of store to derivedfile
+
+    derive(trace) returns the derived dict of the trace, whose entries are
+    listed by names, as (name, width) pairs. """
+    offsets, n = store.offsets, store.offsets[-1]
+    width = sum(w for _, w in names)
+    header = json.dumps({"vehicles": store.vehicles, "offsets": offsets,
+                         "digest": store.digest,
+                         "columns": [list(nw) for nw in names]}).encode()
+    base = _data_offset(len(header))
+    with open(derivedfile, "wb") as file:
+        file.write(DERIVED_MAGIC)
+        file.write(np.uint64(len(header)).astype("<u8").tobytes())
+        file.write(header)
+        file.write(b"\0" * (base - file.tell()))
+        file.truncate(base + width * 8 * n)
+    if not n:
+        return
+
+    columns = np.memmap(derivedfile, dtype="<f8", mode="r+", offset=base,
+                        shape=(width, n))
+    for i, vehicle in enumerate(store.vehicles):
+        derived = derive(store.load(vehicle))
+        start = offsets[i]
+        row = 0
+        for name, w in names:
+            for values in derived[name]:
+                columns[row, start:start+len(values)] = values
+                row += 1
+    columns.flush()
+    del columns
+
+
+def _map_columns(filename, base, width, n):
+    if not n:
+        return np.empty((width, 0))
+    # plain ndarray views on the mapping, which keep it open
+    return np.asarray(np.memmap(filename, dtype="<f8", mode="r", offset=base,
+                                shape=(width, n)))
+
+
+class TraceStore(object):
+    """ Read-only, memory-mapped view of a file written by pack()
+
+    The store stands for the folder it was packed from: listdir() returns
+    the same sorted vehicle names and load(vehicle) the vehicle's Trace.
+
+    With a derived file (see pack_derived), by default storefile + ".derived"
+    when it exists, loaded Traces come with their derived columns; an empty
+    derivedfile disables it. A derived file written for another packing of
+    the store (whose digest differs) raises ValueError. """
+
+    def __init__(self, storefile, derivedfile=None):
+        self.filename = storefile
+        header, base = _read_header(storefile, MAGIC, "packed trace store")
+        self.vehicles = header["vehicles"]
+        self.offsets = header["offsets"]
+        self.digest = header.get("digest")
+        self.index = {v: i for i, v in enumerate(self.vehicles)}
+        self.columns = _map_columns(storefile, base, len(COLUMNS), self.offsets[-1])
+
+        if derivedfile is None and exists(storefile + ".derived"):
+            derivedfile = storefile + ".derived"
+        self.derivedfile, self.derived = derivedfile or None, []
+        if self.derivedfile:
+            header, base = _read_header(self.derivedfile, DERIVED_MAGIC,
+                                        "derived column file")
+            # derived from another packing of the store, or from a store
+            # packed without digest
+            if (self.digest is None or
+                (header["vehicles"], header["offsets"], header.get("digest")) !=
+                (self.vehicles, self.offsets, self.digest)):
+                raise ValueError('%s does not match %s' % (self.derivedfile, storefile))
+            names = header["columns"]
+            columns = _map_columns(self.derivedfile, base,
+                                   sum(w for _, w in names), self.offsets[-1])
+            row = 0
+            for name, w in names:
+                self.derived.append((name, columns[row:row+w]))
+                row += w
+
+    def __reduce__(self):
+        # processes receiving a store map the file again, rather than a copy
+        return (self.__class__, (self.filename, self.derivedfile or ""))
+
+    def listdir(self):
+        return list(self.vehicles)
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def __contains__(self, vehicle):
+        return vehicle in self.index
+
+    def load(self, vehicle):
+        """ Returns the Trace of vehicle as zero-copy views on the store """
+        i = self.index[vehicle]
+        start, end = self.offsets[i], self.offsets[i+1]
+        pairs = slice(start, max(end - 1, start))
+        return Trace(*(column[start:end] for column in self.columns),
+                     derived={name: tuple(c[pairs] for c in columns)
+                              for name, columns in self.derived})
+
+    def __repr__(self):
+        return '<%s - %s, %d vehicles>' % (self.__class__.__name__,
+                                           self.filename, len(self))
+
+
+### Compact encoding
+#
+# Timestamps are whole seconds: each trace keeps its first timestamp and the
+# int32 deltas between consecutive records. Coordinates are int32 fixed-point
+# numbers with 7 decimals (1e-7 degree, about 1 cm), and altitudes with 4
+# decimals, as written by genbeijing.py. Decoding divides by a power of ten,
+# which gives back exactly the floats parsed from such csv files.
+
+LATLON_SCALE = 10**7
+ALT_SCALE = 10**4
+
+def _fixed(values, scale):
+    scaled = np.round(np.asarray(values, dtype=np.float64) * scale)
+    if scaled.size and np.abs(scaled).max() > np.iinfo(np.int32).max:
+        raise ValueError('values out of the range of the int32 encoding')
+    return scaled.astype(np.int32)
+
+def encode(trace):
+    """ Returns the compact encoding (t0, dt, lat, lon, alt) of a Trace """
+    t = np.asarray(trace.t, dtype=np.float64)
+    if np.any(t != np.floor(t)):
+        raise ValueError('timestamps must be whole seconds to be encoded')
+    dt = np.diff(t, prepend=t[:1])
+    if dt.size and np.abs(dt).max() > np.iinfo(np.int32).max:
+        raise ValueError('time gap out of the range of the int32 encoding')
+    return (float(t[0]) if len(t) else 0., dt.astype(np.int32),
+            _fixed(trace.lat, LATLON_SCALE), _fixed(trace.lon, LATLON_SCALE),
+            _fixed(trace.alt, ALT_SCALE))
+
+def decode(t0, dt, lat, lon, alt):
+    return Trace(t0 + np.cumsum(dt, dtype=np.int64),
+                 lat / LATLON_SCALE, lon / LATLON_SCALE, alt / ALT_SCALE)
+
+
+class CompactFleet(object):
+    """ Traces of a fleet in the compact encoding, concatenated in memory
+
+    Like a TraceStore, it stands for a folder: listdir() returns its sorted
+    vehicle names and load(vehicle) the decoded Trace of the vehicle. """
+
+    filename = None
+
+    def __init__(self, vehicles, offsets, t0, dt, lat, lon, alt):
+        self.vehicles, self.offsets = list(vehicles), list(offsets)
+        self.index = {v: i for i, v in enumerate(self.vehicles)}
+        self.t0, self.dt, self.lat, self.lon, self.alt = t0, dt, lat, lon, alt
+
+    @classmethod
+    def build(cls, folder, loadf=parse):
+        vehicles = sorted(listdir(folder))
+        offsets, encoded = [0], []
+        for vehicle in vehicles:
+            trace = loadf(join(folder, vehicle))
+            if not isinstance(trace, Trace):
+                trace = Trace.from_records(trace)
+            encoded.append(encode(trace))
+            offsets.append(offsets[-1] + len(trace))
+        if not encoded:
+            encoded = [encode(Trace.from_records([]))]
+        t0, *columns = zip(*encoded)
+        return cls(vehicles, offsets, np.array(t0, dtype=np.float64),
+                   *(np.concatenate(c) for c in columns))
+
+    def save(self, filename):
+        np.savez(filename, vehicles=np.array(self.vehicles, dtype=str),
+                 offsets=np.array(self.offsets, dtype=np.int64), t0=self.t0,
+                 dt=self.dt, lat=self.lat, lon=self.lon, alt=self.alt)
+
+    @classmethod
+    def open(cls, filename):
+        with np.load(filename) as f:
+            return cls(f["vehicles"].tolist(), f["offsets"].tolist(),
+                       *(f[c] for c in ("t0", "dt", "lat", "lon", "alt")))
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in (self.t0, self.dt, self.lat, self.lon,
+                                      self.alt))
+
+    def listdir(self):
+        return list(self.vehicles)
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def __contains__(self, vehicle):
+        return vehicle in self.index
+
+    def load(self, vehicle):
+        """ Decodes the Trace of vehicle """
+        i = self.index[vehicle]
+        start, end = self.offsets[i], self.offsets[i+1]
+        return decode(self.t0[i], self.dt[start:end], self.lat[start:end],
+                      self.lon[start:end], self.alt[start:end])
+
+    def __repr__(self):
+        return '<%s - %d vehicles, %d records>' % (self.__class__.__name__,
+                                                   len(self), self.offsets[-1])
+
+
+### Hour index of csv traces
+#
+# One line per trace file of a folder: "vehicle,mtime_ns,o_0,o_1,...,o_24"
+# where mtime_ns is the modification time of the file when indexed and o_h
+# the byte offset of the first record with t >= h hours (o_24 is the size of
+# the file). Day files are sorted by time (see genbeijing.py).
+
+HOUR = 3600
+NB_BUCKETS = 24
+
+def _bucket(t):
+    return min(max(int(t // HOUR), 0), NB_BUCKETS)
+
+def hour_offsets(filename):
+    offsets, pos, h = [], 0, 0
+    with open(filename, "rb") as file:
+        for line in file:
+            if line.strip():
+                b = _bucket(float(line.split(b",", 1)[0]))
+                while h <= b and h < NB_BUCKETS:
+                    offsets.append(pos)
+                    h += 1
+            pos += len(line)
+    return offsets + [pos] * (NB_BUCKETS + 1 - len(offsets))
+
+def build_hour_index(folder, indexfile):
+    with open(indexfile, "w") as file:
+        for vehicle in sorted(listdir(folder)):
+            mtime = stat(join(folder, vehicle)).st_mtime_ns
+            print(vehicle, mtime, *hour_offsets(join(folder, vehicle)),
+                  sep=",", file=file)
+
+
+class HourIndex(object):
+    """ Byte offsets of the hours of the traces of a folder (see
+    build_hour_index), read from indexfile
+
+    load(filename, t0, t1) parses only the hours of filename overlapping
+    [t0, t1], plus the record following them: the result has every record
+    of the full trace with t0 <= t <= t1, so that binslice(data, t0, t1)
+    gives the same records as on load(filename). The offsets are only
+    valid while check(filename) holds. """
+
+    def __init__(self, indexfile):
+        self.offsets, self.mtimes = {}, {}
+        with open(indexfile, "r") as file:
+            for line in file:
+                vehicle, *offsets = line.rstrip("\n").split(",")
+                # indexes without mtimes are never valid
+                if len(offsets) > NB_BUCKETS + 1:
+                    self.mtimes[vehicle] = int(offsets.pop(0))
+                self.offsets[vehicle] = list(map(int, offsets))
+
+    def __contains__(self, filename):
+        return basename(filename) in self.offsets
+
+    def check(self, filename):
+        # an index is stale once its trace file has been modified
+        vehicle, st = basename(filename), stat(filename)
+        return (vehicle in self.offsets and
+                self.mtimes.get(vehicle) == st.st_mtime_ns and
+                self.offsets[vehicle][-1] == st.st_size)
+
+    def load(self, filename, t0=0, t1=NB_BUCKETS*HOUR):
+        offsets = self.offsets[basename(filename)]
+        start, end = offsets[_bucket(t0)], offsets[_bucket(t1)]
+        with open(filename, "rb") as file:
+            file.seek(start)
+            lines = file.read(max(end - start, 0)).splitlines()
+            # the bucket of t1 may still hold records with t <= t1
+            for line in file:
+                lines.append(line)
+                if line.strip() and float(line.split(b",", 1)[0]) > t1:
+                    break
+        return [tuple(map(float,line.strip().split(b",")))
+                for line in lines if line.strip()]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""NumPy versions of the record-by-record templates of query.py
+
+Each function takes the same arguments as its namesake in query.py, records
+given either as a Trace (tracestore.py), whose columns are used as they are,
+or as a list of records, and evaluates it with boolean masks and reductions
+over the (t, lat, lon) columns. The comparisons are the same as in query.py,
+so the spatial templates give identical answers; speeds use NumPy's
+trigonometric functions and may differ from math's in the last bits.
+See scripts/experiments/check_vectorized.py for a cross-check.
+"""
+
+import numpy as np
+
+from tracestore import Trace, TraceStore, pack_derived
+
+EARTH_RADIUS = 6371000
+
+def columns(data):
+    """ (t, lat, lon) arrays of a Trace or of a list of records """
+    if isinstance(data, Trace):
+        return data.t, data.lat, data.lon
+    if not len(data):
+        return np.empty(0), np.empty(0), np.empty(0)
+    if isinstance(data[0], tuple) and len(data[0]) <= 4:
+        array = np.array(data, dtype=np.float64)
+    else:
+        array = np.array([rec[:3] for rec in data], dtype=np.float64)
+    return array[:,0], array[:,1], array[:,2]
+
+### Spatial templates
+
+def is_within(x, y, p1, p2):
+    return (p2[0] <= x) & (x <= p1[0]) & (p1[1] <= y) & (y <= p2[1])
+
+def passed_by(data, p1, p2):
+    t, lat, lon = columns(data)
+    return bool(is_within(lat, lon, p1, p2).any())
+
+def stayed_in(data, p1, p2):
+    t, lat, lon = columns(data)
+    return len(t) > 0 and bool(is_within(lat, lon, p1, p2).all())
+
+def allrec_outside_zone(data, p1, p2):
+    t, lat, lon = columns(data)
+    return len(t) > 0 and not is_within(lat, lon, p1, p2).any()
+
+def space_filter(data, p1, p2):
+    t, lat, lon = columns(data)
+    mask = is_within(lat, lon, p1, p2)
+    return list(zip(t[mask].tolist(), lat[mask].tolist(), lon[mask].tolist()))
+
+### Distances and speeds
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Haversine distance in meters, element-wise (see query.distance) """
+    dlat, dlon = np.radians(lat2 - lat1), np.radians(lon2 - lon1)
+    a = (np.sin(dlat/2) * np.sin(dlat/2) + np.cos(np.radians(lat1)) *
+         np.cos(np.radians(lat2)) * np.sin(dlon/2) * np.sin(dlon/2))
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def times(data):
+    """ Array of the timestamps of the records """
+    if isinstance(data, Trace):
+        return data.t
+    return np.fromiter((rec[0] for rec in data), np.float64, len(data))
+
+def time_steps(data):
+    """ Array of the time gaps abs(t[j+1]-t[j]) between consecutive records """
+    t = times(data)
+    return np.abs(t[1:] - t[:-1])
+
+def steps(data):
+    """ Kernel over the consecutive pairs of records, in one pass
+
+    Returns the (dt, dist, speed) arrays of the time gaps, haversine
+    distances and instant speeds (see query.instant_speed) of the pairs
+    (data[j], data[j+1]), computed once per trace (see derive). """
+    return derive(data, "steps", lambda: column_steps(*columns(data)))
+
+def column_steps(t, lat, lon):
+    """ steps() over the columns of the records """
+    dt = np.abs(t[1:] - t[:-1])
+    dist = distance(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    speed = np.zeros(len(dt))
+    moving = dt != 0
+    speed[moving] = 3.6 * dist[moving] / dt[moving]
+    return dt, dist, speed
+
+def column_headings(t, lat, lon):
+    """ Initial bearings of the pairs, in degrees clockwise from north """
+    phi1, phi2 = np.radians(lat[:-1]), np.radians(lat[1:])
+    dlon = np.radians(lon[1:] - lon[:-1])
+    y = np.sin(dlon) * np.cos(phi2)
+    x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
+
+def headings(data):
+    """ Array of the headings of the pairs (data[j], data[j+1]) """
+    return derive(data, "headings",
+                  lambda: (column_headings(*columns(data)),))[0]
+
+def speeds(data, delta=15):
+    """ Array of the values yielded by query.speed(data, delta) """
+    dt, _, speed = steps(data)
+    return speed[dt <= delta]
+
+def speed(data, delta=15):
+    yield from speeds(data, delta).tolist()
+
+def average_speed(data):
+    s = speeds(data).tolist()
+    return sum(s)/len(s) if s else None
+
+### Run segmentation
+
+def runs(valid):
+    """ Bounds of the batches of query.continuous, given the validities of
+    the pairs of records (valid[j] for (data[j], data[j+1]))
+
+    Returns (starts, ends) such that the batches are data[starts[b]:ends[b]]:
+    like continuous, a run of valid pairs from record i to record j gives
+    the batch data[i:j], without its last record, and single records give
+    no batch. """
+    valid = np.asarray(valid, dtype=bool)
+    breaks = np.flatnonzero(~valid)
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [len(valid)]))
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+def batches(t, valid, minspan=0, nb_records=1):
+    """ Bounds of the batches of runs(valid) with at least nb_records records
+    spanning at least minspan seconds (see query.continuous_batches), t being
+    the timestamps of the records """
+    starts, ends = runs(valid)
+    keep = ((ends - starts >= nb_records) &
+            (t[ends - 1] - t[starts] >= minspan))
+    return starts[keep], ends[keep]
+
+### Derived columns
+# The columns derived from the pairs of records (steps and headings) of a
+# Trace are computed once, on first use, and kept in its derived dict, which
+# its slices share and a TraceStore may load from disk (see
+# pack_derived_store). Lists of records may be modified in place, so their
+# columns are computed on every use.
+
+DERIVED = (("steps", 3), ("headings", 1))
+
+def derived(data):
+    """ Derived dict of the records, or None for sequences without one """
+    if isinstance(data, Trace):
+        return data.derived
+    return None
+
+def derive(data, name, compute):
+    # compute() returns a tuple of columns of the pairs; they are read-only
+    # once cached, being shared by every later query on the trace
+    cache = derived(data)
+    if cache is None:
+        return compute()
+    if name not in cache:
+        columns = compute()
+        for column in columns:
+            column.setflags(write=False)
+        cache[name] = columns
+    return cache[name]
+
+def derive_all(data):
+    steps(data)
+    headings(data)
+    return derived(data)
+
+def pack_derived_store(storefile, derivedfile=None):
+    """ Writes the derived columns of the traces of a packed store, by
+    default to storefile + ".derived", where TraceStore finds them """
+    pack_derived(TraceStore(storefile, derivedfile=""),
+                 derivedfile or storefile + ".derived", derive_all, DERIVED)